@@ -0,0 +1,60 @@
+"""
+Speed and accuracy of the fastmath kernels against the default ones, for
+each dtype. The ``track_`` benchmarks report the largest relative error
+against the reference values of the test suite and against the default
+kernels.
+"""
+from itertools import product
+
+import numpy as np
+
+import fastjmd95
+from fastjmd95.test import reference_values
+
+FUNCTIONS = ["rho", "drhodt", "drhods"]
+DTYPES = ["float32", "float64"]
+
+
+class FastMath:
+    params = (FUNCTIONS, DTYPES, [False, True])
+    param_names = ["function", "dtype", "fastmath"]
+
+    def setup(self, function, dtype, fastmath):
+        rng = np.random.default_rng(0)
+        shape = (10 ** 7,)
+        self.args = [
+            rng.uniform(30, 40, shape).astype(dtype),
+            rng.uniform(-2, 30, shape).astype(dtype),
+            rng.uniform(0, 5000, shape).astype(dtype),
+        ]
+        self.func = getattr(fastjmd95, function)
+        # compile outside of the timed code
+        self.func(*[a[:1] for a in self.args], fastmath=fastmath)
+
+    def time_call(self, function, dtype, fastmath):
+        self.func(*self.args, fastmath=fastmath)
+
+
+class FastMathAccuracy:
+    params = (FUNCTIONS, DTYPES, [False, True])
+    param_names = ["function", "dtype", "fastmath"]
+    unit = "relative error"
+
+    def setup(self, function, dtype, fastmath):
+        # the grid of the reference values
+        s0 = np.arange(30, 41, 2.0)
+        t0 = np.arange(-2, 35, 2.0)
+        p0 = np.arange(0, 5000.0, 1000.0)
+        p, t, s = np.array(list(product(p0, t0, s0))).transpose()
+        self.args = [a.astype(dtype) for a in (s, t, p)]
+        self.func = getattr(fastjmd95, function)
+        self.expected = getattr(reference_values, function + "_expected")
+
+    def track_error(self, function, dtype, fastmath):
+        actual = self.func(*self.args, fastmath=fastmath).astype("float64")
+        return float(np.abs((actual - self.expected) / self.expected).max())
+
+    def track_error_vs_default(self, function, dtype, fastmath):
+        actual = self.func(*self.args, fastmath=fastmath).astype("float64")
+        default = self.func(*self.args).astype("float64")
+        return float(np.abs((actual - default) / default).max())
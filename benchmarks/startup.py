@@ -0,0 +1,43 @@
+"""
+Import time of fastjmd95 and time to the first result, with and without the
+on-disk cache of compiled kernels. Each benchmark runs in a fresh interpreter.
+"""
+import tempfile
+
+COLD_SETUP = """
+import os, tempfile
+os.environ['FASTJMD95_CACHE_DIR'] = tempfile.mkdtemp()
+"""
+
+WARM_SETUP = """
+import os, subprocess, sys
+os.environ['FASTJMD95_CACHE_DIR'] = {cache_dir!r}
+subprocess.check_call([sys.executable, '-c', {first_call!r}])
+"""
+
+IMPORT = "import fastjmd95"
+
+FIRST_CALL = "import fastjmd95; fastjmd95.rho(35.5, 3., 3000.)"
+
+
+def _warm_setup():
+    # populate the cache from a separate process, so that the timed code
+    # only loads compiled kernels
+    return WARM_SETUP.format(cache_dir=tempfile.mkdtemp(), first_call=FIRST_CALL)
+
+
+def timeraw_import_cold():
+    return IMPORT, COLD_SETUP
+
+
+def timeraw_import_warm():
+    return IMPORT, _warm_setup()
+
+
+def timeraw_first_call_cold():
+    # an empty cache directory, so the kernel is compiled
+    return FIRST_CALL, COLD_SETUP
+
+
+def timeraw_first_call_warm():
+    return FIRST_CALL, _warm_setup()
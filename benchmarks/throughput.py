@@ -0,0 +1,130 @@
+"""
+Throughput of rho, drhodt and drhods through every dispatch path of
+`jmd95wrapper`: numpy, xarray, dask and dask-backed xarray, for float32 and
+float64 inputs from scalars up to 10^9 elements, and for each dask scheduler.
+
+Besides the time per call, the ``track_`` benchmarks report elements per
+second and the effective bandwidth in GB/s, counting the three inputs read
+and the output written once each.
+
+In-memory inputs are random; dask inputs are generated inside the graph with
+``dask.array.full``, so that 10^9 elements fit in memory and generating them
+costs about as much as writing the output. Combinations that cannot run (in
+memory arrays of 10^9 elements, dask arrays of a single element) are skipped.
+"""
+import time
+
+import numpy as np
+import dask.array as dsa
+import xarray as xr
+
+import fastjmd95
+
+FUNCTIONS = ["rho", "drhodt", "drhods"]
+DTYPES = ["float32", "float64"]
+SIZES = [1, 10 ** 3, 10 ** 6, 10 ** 7, 10 ** 9]
+SCHEDULERS = ["synchronous", "threads", "processes", "distributed"]
+
+# elements per dask chunk
+CHUNK_SIZE = 10 ** 7
+# largest in-memory inputs
+MAX_IN_MEMORY = 10 ** 7
+
+S, T, P = 35.5, 3.0, 3000.0
+
+
+def _best_time(func, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+class _Throughput:
+    timeout = 600
+    processes = 1
+
+    def _rate(self):
+        return self.size / _best_time(self._call)
+
+    def time_call(self, *params):
+        self._call()
+
+    def track_elements_per_second(self, *params):
+        return self._rate()
+
+    track_elements_per_second.unit = "elements/s"
+
+    def track_gbytes_per_second(self, *params):
+        itemsize = np.dtype(self.dtype).itemsize
+        return self._rate() * 4 * itemsize / 1e9
+
+    track_gbytes_per_second.unit = "GB/s"
+
+
+class InMemory(_Throughput):
+    params = (FUNCTIONS, DTYPES, SIZES, ["numpy", "xarray"])
+    param_names = ["function", "dtype", "size", "array_type"]
+
+    def setup(self, function, dtype, size, array_type):
+        if size > MAX_IN_MEMORY:
+            raise NotImplementedError
+        self.func = getattr(fastjmd95, function)
+        self.dtype, self.size = dtype, size
+        if size == 1:
+            # scalars
+            self.args = [np.dtype(dtype).type(v) for v in (S, T, P)]
+        else:
+            rng = np.random.default_rng(0)
+            self.args = [
+                rng.uniform(30, 40, size).astype(dtype),
+                rng.uniform(-2, 30, size).astype(dtype),
+                rng.uniform(0, 5000, size).astype(dtype),
+            ]
+        if array_type == "xarray":
+            dims = [] if size == 1 else ["i"]
+            self.args = [xr.DataArray(a, dims=dims) for a in self.args]
+        # compile outside of the timed code
+        self.func(*self.args)
+
+    def _call(self):
+        self.func(*self.args)
+
+
+class Dask(_Throughput):
+    params = (FUNCTIONS, DTYPES, SIZES, ["dask", "xarray_dask"], SCHEDULERS)
+    param_names = ["function", "dtype", "size", "array_type", "scheduler"]
+
+    def setup(self, function, dtype, size, array_type, scheduler):
+        if size == 1:
+            raise NotImplementedError
+        self.func = getattr(fastjmd95, function)
+        self.dtype, self.size = dtype, size
+        chunks = min(size, CHUNK_SIZE)
+        self.args = [dsa.full(size, v, dtype=dtype, chunks=chunks) for v in (S, T, P)]
+        if array_type == "xarray_dask":
+            self.args = [xr.DataArray(a, dims=["i"]) for a in self.args]
+        self.client = None
+        self.scheduler = scheduler
+        if scheduler == "distributed":
+            from dask.distributed import Client, LocalCluster
+
+            self.client = Client(LocalCluster(processes=True))
+            # the client is the default scheduler
+            self.scheduler = None
+            self.client.run(fastjmd95.warmup, [function])
+        # compile outside of the timed code
+        self._call_on(self.args[0][:1], self.args[1][:1], self.args[2][:1])
+
+    def teardown(self, *params):
+        if self.client is not None:
+            self.client.close()
+            self.client.cluster.close()
+
+    def _call_on(self, *args):
+        self.func(*args).compute(scheduler=self.scheduler)
+
+    def _call(self):
+        self._call_on(*self.args)
@@ -2,4 +2,47 @@ from ._version import get_versions
 __version__ = get_versions()['version']
 del get_versions
 
-from .jmd95wrapper import rho, drhodt, drhods
+from . import aot
+
+if not aot.kernels:
+    # no ahead-of-time compiled kernels, use the JIT ones
+    from . import jmd95numba
+
+from .jmd95wrapper import (
+    rho,
+    drhodt,
+    drhods,
+    rho_and_derivatives,
+    alpha,
+    beta,
+    alpha_beta,
+    eos_fields,
+    eos_fields_z,
+    rho_levels,
+    rho_z,
+    drhodt_z,
+    drhods_z,
+    sigma,
+    sigma0,
+    sigma1,
+    sigma2,
+    sigma3,
+    sigma4,
+    n2,
+    theta_from_rho,
+    s_from_rho,
+    remap_to_density,
+    census,
+    warmup,
+)
+from .options import set_options
+from .wetpoints import WetPoints
+
+try:
+    import xarray
+except ImportError:
+    pass
+else:
+    # registers the Dataset.jmd95 accessor
+    from . import accessor
+    del xarray
@@ -0,0 +1,55 @@
+"""
+Selection of kernel loops by dtype, shared by the JIT kernels, the
+ahead-of-time compiled kernels and the wrappers; it does not import numba.
+"""
+
+import numpy as np
+
+
+def dtype_of(arg):
+    # the dtype of an array or array-like, without computing lazy arrays;
+    # Python scalars are kept as they are, so that numpy types them weakly
+    if isinstance(arg, (int, float, complex)):
+        return arg
+    if hasattr(arg, "dtype"):
+        return arg.dtype
+    return np.asarray(arg).dtype
+
+
+def selecting_inputs(inputs):
+    """ Positions of the arguments that select a loop, given the input dtypes
+    of each loop: those whose dtype differs between loops, such as fields,
+    but not float64 coefficients that every loop reads as they are
+    """
+    varying = [i for i, dtypes in enumerate(zip(*inputs)) if len(set(dtypes)) > 1]
+    return varying or list(range(len(inputs[0])))
+
+
+def select_loop(name, loops, args, dtype=None):
+    """ The index in `loops`, (input dtype, output dtype) pairs, of the loop
+    of kernel `name` for `args`: the loop matching the inputs exactly (as
+    numba's gufuncs do), or the first that they can be safely cast to; with
+    `dtype`, the loop writing that dtype, reading the inputs as they are if
+    there is one
+    """
+    result_type = np.result_type(*[dtype_of(a) for a in args])
+    loops = [(np.dtype(i), np.dtype(o)) for i, o in loops]
+    if dtype is not None:
+        dtype = np.dtype(dtype)
+        candidates = [index for index, loop in enumerate(loops) if loop[1] == dtype]
+        for index in candidates:
+            if loops[index][0] == result_type:
+                return index
+        if candidates:
+            return candidates[0]
+    else:
+        for index, (loop_dtype, _) in enumerate(loops):
+            if loop_dtype == result_type:
+                return index
+        for index, (loop_dtype, _) in enumerate(loops):
+            if np.can_cast(result_type, loop_dtype):
+                return index
+    raise TypeError(
+        "%s: no loop matching the specified signature for %s"
+        % (name, result_type if dtype is None else dtype)
+    )
@@ -0,0 +1,100 @@
+import numpy as np
+import xarray as xr
+
+from .jmd95wrapper import eos_fields, eos_fields_z
+
+# attributes of the fields in the datasets returned by the accessor
+FIELD_ATTRS = {
+    'rho': {'long_name': 'in-situ density', 'units': 'kg m-3'},
+    'drhodt': {'long_name': 'derivative of density with respect to potential temperature',
+               'units': 'kg m-3 degC-1'},
+    'drhods': {'long_name': 'derivative of density with respect to salinity',
+               'units': 'kg m-3 psu-1'},
+    'alpha': {'long_name': 'thermal expansion coefficient', 'units': 'degC-1'},
+    'beta': {'long_name': 'haline contraction coefficient', 'units': 'psu-1'},
+}
+FIELD_ATTRS.update({
+    'sigma%d' % n: {'long_name': 'potential density anomaly referenced to %d dbar'
+                                 % (1000 * n),
+                    'units': 'kg m-3'}
+    for n in range(5)})
+
+
+@xr.register_dataset_accessor('jmd95')
+class JMD95Accessor:
+    """
+    Equation of state diagnostics of a Dataset, as ``ds.jmd95``.
+    """
+
+    def __init__(self, ds):
+        self._ds = ds
+
+    def _variable(self, name_or_value):
+        if isinstance(name_or_value, str):
+            return self._ds[name_or_value]
+        return name_or_value
+
+    def compute(self, fields=('rho',), salt='SALT', theta='THETA', pressure=None,
+                depth=None, lat=None, **kwargs):
+        """
+        Compute equation of state fields in one pass over the dataset.
+
+        Each chunk of the inputs is read once and all fields are computed
+        from it by a single task (see `fastjmd95.eos_fields`); coordinates
+        and chunks follow the inputs.
+
+        Parameters
+        ----------
+        fields : sequence of str
+            Fields to compute, any of ``'rho'``, ``'drhodt'``, ``'drhods'``,
+            ``'alpha'``, ``'beta'`` and ``'sigma0'`` to ``'sigma4'``.
+        salt, theta : str
+            Names of the practical salinity and potential temperature
+            variables.
+        pressure : str or array_like
+            Name of the pressure [dbar] variable, or the pressure itself;
+            it must not be negative, which is checked unless it is a dask
+            array. Heights such as MITgcm's ``Z`` go to `depth` instead.
+        depth : str or array_like
+            Instead of `pressure`: name of the depth [m] variable, or the
+            depth itself, converted to pressure in the kernels as in
+            `fastjmd95.eos_fields_z`. Its sign is ignored, so MITgcm's height
+            ``Z`` works too.
+        lat : str or array_like, optional
+            With `depth`: name of the latitude variable, or the latitude,
+            for the Saunders (1981) conversion.
+        **kwargs
+            ``engine``, ``dtype``, ``mask`` and ``fill_value``, as for
+            `fastjmd95.rho`.
+
+        Returns
+        -------
+        xarray.Dataset
+            One variable per field, with the attributes of the dataset.
+
+        Example
+        -------
+        >>> ds.jmd95.compute(fields=['rho', 'sigma0', 'alpha', 'beta'],
+        ...                  salt='SALT', theta='THETA', pressure='PRESS')
+        >>> ds.jmd95.compute(fields=['rho'], depth='Z', lat='YC')
+        """
+        if (pressure is None) == (depth is None):
+            raise ValueError("either pressure [dbar] or depth [m] must be given, "
+                             "as a variable name or values")
+        fields = list(fields)
+        s, t = self._variable(salt), self._variable(theta)
+        if depth is None:
+            p = self._variable(pressure)
+            # lazy pressures are not computed for this
+            if getattr(p, 'chunks', None) is None and np.any(np.asarray(p) < 0):
+                raise ValueError("pressure [dbar] must not be negative; pass heights "
+                                 "such as Z as depth=")
+            results = eos_fields(s, t, p, fields=fields, **kwargs)
+        else:
+            results = eos_fields_z(s, t, self._variable(depth),
+                                   None if lat is None else self._variable(lat),
+                                   fields=fields, **kwargs)
+        out = xr.Dataset(attrs=self._ds.attrs)
+        for name, result in zip(fields, results):
+            out[name] = result.assign_attrs(FIELD_ATTRS.get(name, {}))
+        return out
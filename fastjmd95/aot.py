@@ -0,0 +1,197 @@
+"""
+Ahead-of-time compiled kernels.
+
+``python -m fastjmd95.aot`` compiles the elementwise kernels of `jmd95numba`
+into the native module ``fastjmd95._jmd95aot``. When that module is present,
+the serial engine uses it and importing fastjmd95 neither imports numba nor
+initializes LLVM; when it is not, the JIT ufuncs are used.
+
+Each loop of each kernel is exported as a function over contiguous 1-D
+arrays, named after the kernel and its dtype, e.g. ``rho_float64(s, t, p,
+out)``, or its input and output dtypes if they differ, e.g.
+``rho_float32_float64``; the functions in `kernels` broadcast their arguments
+and call these loops like the equivalent ufuncs.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from ._dispatch import select_loop, selecting_inputs
+
+try:
+    from . import _jmd95aot
+except ImportError:
+    _jmd95aot = None
+
+MODULE_NAME = "_jmd95aot"
+
+
+def _manifest_path(output_dir):
+    return os.path.join(output_dir, MODULE_NAME + ".json")
+
+
+def _read_manifest(module):
+    # kernel name -> number of inputs and outputs, (input, output) dtypes of
+    # its loops and the dtypes of all their inputs, for every kernel in the
+    # native module, which cannot hold anything but functions
+    with open(_manifest_path(os.path.dirname(module.__file__))) as f:
+        return json.load(f)
+
+
+def _loop_name(name, input_dtype, output_dtype):
+    if input_dtype == output_dtype:
+        return "%s_%s" % (name, output_dtype)
+    return "%s_%s_%s" % (name, input_dtype, output_dtype)
+
+
+def _writable(out, shape, dtype):
+    # whether a loop can write straight into `out`
+    return (
+        out is not None
+        and out.shape == shape
+        and out.dtype == dtype
+        and out.flags.c_contiguous
+    )
+
+
+def _call(module, name, nin, nout, loops, inputs, *args, dtype=None, out=None):
+    if len(args) != nin:
+        raise TypeError("%s() takes %d arguments (%d given)" % (name, nin, len(args)))
+    selecting = [args[i] for i in selecting_inputs(inputs)]
+    index = select_loop(name, loops, selecting, dtype)
+    input_dtype, dtype = loops[index]
+    dtype = np.dtype(dtype)
+    arrays = np.broadcast_arrays(
+        *[np.asarray(a, dtype=d) for a, d in zip(args, inputs[index])]
+    )
+    shape = arrays[0].shape
+    inputs = [np.ascontiguousarray(a).reshape(-1) for a in arrays]
+    scalar = shape == () and out is None
+    if out is None:
+        out = [None] * nout
+    elif not isinstance(out, tuple):
+        out = (out,)
+    # write straight into out where the loop can, into temporaries otherwise
+    outputs = [
+        o if _writable(o, shape, dtype) else np.empty(shape, dtype=dtype) for o in out
+    ]
+    loop = getattr(module, _loop_name(name, input_dtype, dtype.name))
+    loop(*inputs, *[o.reshape(-1) for o in outputs])
+    for o, output in zip(out, outputs):
+        if o is not None and o is not output:
+            np.copyto(o, output, casting="same_kind")
+    outputs = [output if o is None else o for o, output in zip(out, outputs)]
+    if scalar:
+        outputs = [o[()] for o in outputs]
+    return outputs[0] if nout == 1 else tuple(outputs)
+
+
+def _make_kernel(module, name, nin, nout, loops, inputs=None):
+    if inputs is None:
+        # built before the inputs were listed: all of them in the loop dtype
+        inputs = [[loop[0]] * nin for loop in loops]
+
+    def kernel(*args, dtype=None, out=None):
+        return _call(
+            module, name, nin, nout, loops, inputs, *args, dtype=dtype, out=out
+        )
+
+    kernel.__name__ = name
+    return kernel
+
+
+def _load(module):
+    if module is None:
+        return {}
+    return {
+        name: _make_kernel(module, name, **kernel)
+        for name, kernel in _read_manifest(module).items()
+    }
+
+
+# the compiled kernels, by name; empty if the native module was not built
+kernels = _load(_jmd95aot)
+
+
+def _exportable(signatures, layout):
+    # elementwise kernels only: plain ufuncs, or gufuncs without core
+    # dimensions whose outputs share a dtype, as the loops allocate them
+    if layout is None:
+        return True
+    nin = layout.split("->")[0].count("(")
+    return set(layout) <= set("(),->") and all(
+        len(set(str(t.dtype) for t in signature[nin:])) == 1 for signature in signatures
+    )
+
+
+def _loop_source(nin, nout):
+    # numba cannot compile loops over *args, so the loop is written out
+    inputs = ["x%d" % i for i in range(nin)]
+    outputs = ["y%d" % i for i in range(nout)]
+    lines = ["def loop(%s):" % ", ".join(inputs + outputs)]
+    lines.append("    for i in range(y0.shape[0]):")
+    args = ", ".join("%s[i]" % x for x in inputs)
+    if nout == 1:
+        lines.append("        y0[i] = kernel(%s)" % args)
+    else:
+        # gufunc kernels write their scalar outputs to 1-element arrays
+        views = ", ".join("%s[i:i + 1]" % y for y in outputs)
+        lines.append("        kernel(%s, %s)" % (args, views))
+    return "\n".join(lines)
+
+
+def _signature_dtypes(signature, layout):
+    if layout is None:
+        return list(signature.args) + [signature.return_type]
+    return [getattr(t, "dtype", t) for t in signature]
+
+
+def build(output_dir=None):
+    """
+    Compile every elementwise kernel in `jmd95numba` into the native module
+    ``fastjmd95._jmd95aot``.
+
+    Parameters
+    ----------
+    output_dir : str, optional
+        Where the module is written; defaults to the fastjmd95 package.
+    """
+    from numba import njit
+    from numba.pycc import CC
+
+    from . import jmd95numba
+
+    output_dir = output_dir or os.path.dirname(os.path.abspath(__file__))
+    cc = CC(MODULE_NAME)
+    cc.output_dir = output_dir
+
+    exported = {}
+    for name, (func, signatures, layout) in jmd95numba._kernels.items():
+        if name.startswith("_") or not _exportable(signatures, layout):
+            continue
+        nin = func.__code__.co_argcount
+        if layout is not None:
+            nin = layout.split("->")[0].count("(")
+        nout = 1 if layout is None else layout.split("->")[1].count("(")
+        namespace = {"kernel": njit(func)}
+        exec(_loop_source(nin, nout), namespace)
+        loops = []
+        inputs = []
+        for signature in signatures:
+            dtypes = _signature_dtypes(signature, layout)
+            loop = [str(dtypes[0]), str(dtypes[-1])]
+            export = "void(%s)" % ", ".join("%s[::1]" % d for d in dtypes)
+            cc.export(_loop_name(name, *loop), export)(namespace["loop"])
+            loops.append(loop)
+            inputs.append([str(d) for d in dtypes[:nin]])
+        exported[name] = {"nin": nin, "nout": nout, "loops": loops, "inputs": inputs}
+
+    cc.compile()
+    with open(_manifest_path(output_dir), "w") as f:
+        json.dump(exported, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    build()
@@ -0,0 +1,140 @@
+"""
+Command-line batch processing of netCDF and zarr stores.
+
+``fastjmd95 INPUT OUTPUT --pressure PRESS --fields rho alpha beta`` reads
+salinity, potential temperature and pressure (or ``--depth`` and ``--lat``)
+from INPUT and writes the fields to OUTPUT, chunk by chunk: chunks are sized
+so that the inputs and results of one chunk fit in ``--memory``, each chunk
+is computed by the parallel engine on ``--threads`` threads, and written
+before the next one is read. Paths ending in ``.zarr`` (or directories) are zarr stores, others are
+netCDF files. Requires xarray and dask, and a netCDF or zarr backend.
+"""
+import argparse
+import os
+
+import numpy as np
+
+from .options import set_options
+
+DEFAULT_MEMORY = '256MB'
+
+
+def _chunks(shape, points):
+    # the largest chunks of at most `points` points, whole along the
+    # trailing dimensions first
+    chunks = []
+    for size in reversed(shape):
+        n = min(size, max(points, 1))
+        chunks.append(n)
+        points //= size
+    return tuple(reversed(chunks))
+
+
+def _is_zarr(path):
+    return path.rstrip('/').endswith('.zarr') or os.path.isdir(path)
+
+
+def _open(path):
+    # lazily, without dask: the chunks are chosen from the memory budget,
+    # so that each task reads its own slice of the variables only
+    import xarray as xr
+    return xr.open_dataset(path, engine='zarr' if _is_zarr(path) else None)
+
+
+def _name_or_value(value):
+    # a variable name, or a constant, e.g. pressure in dbar
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def _parser():
+    from .accessor import FIELD_ATTRS
+
+    parser = argparse.ArgumentParser(
+        prog='fastjmd95',
+        description='Compute JMD95 equation of state fields of a netCDF file '
+                    'or zarr store, in chunks of bounded memory.')
+    parser.add_argument('input', help='netCDF file or zarr store to read')
+    parser.add_argument('output', help='netCDF file or zarr store to write')
+    parser.add_argument('--fields', nargs='+', default=['rho'], choices=sorted(FIELD_ATTRS),
+                        metavar='FIELD',
+                        help='fields to compute, any of %s (default: rho)'
+                             % ' '.join(sorted(FIELD_ATTRS)))
+    parser.add_argument('--salt', default='SALT',
+                        help='practical salinity variable (default: SALT)')
+    parser.add_argument('--theta', default='THETA',
+                        help='potential temperature variable (default: THETA)')
+    vertical = parser.add_mutually_exclusive_group(required=True)
+    vertical.add_argument('--pressure', type=_name_or_value,
+                          help='pressure [dbar] variable, or a constant pressure')
+    vertical.add_argument('--depth', type=_name_or_value,
+                          help='depth [m] variable, or a constant depth, instead of '
+                               'pressure; its sign is ignored, so heights such as Z work')
+    parser.add_argument('--lat', type=_name_or_value,
+                        help='with --depth: latitude variable, or a constant latitude, '
+                             'for the Saunders (1981) pressure (default: hydrostatic)')
+    parser.add_argument('--memory', default=DEFAULT_MEMORY,
+                        help='memory for the arrays of one chunk, e.g. 2GB '
+                             '(default: %s)' % DEFAULT_MEMORY)
+    parser.add_argument('--threads', type=int, default=None,
+                        help="threads of the parallel engine (default: numba's)")
+    parser.add_argument('--engine', choices=['serial', 'parallel'], default='parallel',
+                        help='engine of the kernels (default: parallel)')
+    return parser
+
+
+def compute(ds, fields=('rho',), salt='SALT', theta='THETA', pressure=None,
+            depth=None, lat=None, memory=DEFAULT_MEMORY, **kwargs):
+    """
+    The fields of `ds`, lazily, in chunks whose inputs and results take at
+    most `memory` bytes (an int, or a string like ``'2GB'``). Other
+    arguments are as for ``ds.jmd95.compute``, whose options are those in
+    effect when this is called.
+    """
+    from dask.utils import parse_bytes
+    from . import accessor  # noqa: F401, registers ds.jmd95
+
+    if isinstance(memory, str):
+        memory = parse_bytes(memory)
+    template = ds[salt]
+    # salinity, temperature, pressure or depth, latitude and the results, at
+    # the input precision
+    itemsize = np.result_type(template, ds[theta]).itemsize
+    arrays = 3 + (lat is not None) + len(fields)
+    points = memory // (itemsize * arrays)
+    chunks = dict(zip(template.dims, _chunks(template.shape, points)))
+    ds = ds.chunk({dim: n for dim, n in chunks.items()})
+    return ds.jmd95.compute(fields=fields, salt=salt, theta=theta,
+                            pressure=pressure, depth=depth, lat=lat, **kwargs)
+
+
+def main(argv=None):
+    """ Entry point of the ``fastjmd95`` command. """
+    import dask
+    import numba
+
+    parser = _parser()
+    args = parser.parse_args(argv)
+    if args.threads is not None and not 1 <= args.threads <= numba.config.NUMBA_NUM_THREADS:
+        parser.error('--threads must be between 1 and NUMBA_NUM_THREADS (%d), got %d'
+                     % (numba.config.NUMBA_NUM_THREADS, args.threads))
+    if args.lat is not None and args.depth is None:
+        parser.error('--lat requires --depth')
+    ds = _open(args.input)
+    # the options are taken when the graph is built; one chunk at a time: the
+    # threads are the kernels', not dask's
+    with set_options(num_threads=args.threads), dask.config.set(scheduler='synchronous'):
+        out = compute(ds, fields=args.fields, salt=args.salt, theta=args.theta,
+                      pressure=args.pressure, depth=args.depth, lat=args.lat,
+                      memory=args.memory, engine=args.engine)
+        if _is_zarr(args.output):
+            out.to_zarr(args.output, mode='w')
+        else:
+            out.to_netcdf(args.output)
+    ds.close()
+
+
+if __name__ == '__main__':
+    main()
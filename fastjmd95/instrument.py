@@ -0,0 +1,85 @@
+"""
+Opt-in instrumentation of the public functions.
+
+With ``set_options(instrument=callback)``, every evaluation of a kernel calls
+``callback(call)`` with a `Call` record. For dask inputs (also inside
+DataArrays) a record is made for each block, where it is computed: with the
+processes or distributed schedulers the callback runs in the workers, on a
+copy, so it should send its records elsewhere rather than keep them.
+"""
+import collections
+import functools
+import threading
+import time
+
+import numpy as np
+
+# function: name of the public function; path: 'numpy', 'dask' or 'xarray';
+# dtype: dtype of the result; elements: number of points computed;
+# seconds: wall time of the kernel
+Call = collections.namedtuple('Call', ['function', 'path', 'dtype', 'elements', 'seconds'])
+
+Totals = collections.namedtuple('Totals', ['calls', 'elements', 'seconds'])
+
+
+def timed(func, callback, name, path, dtype, size=None):
+    """
+    Wrap `func` so that each call is reported to `callback` as a `Call`.
+    `size(*args)` gives the number of points of a call; by default, the
+    size of the arguments broadcast together.
+    """
+    @functools.wraps(func)
+    def timed_func(*args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        elements = np.broadcast(*args).size if size is None else size(*args)
+        # empty inputs are dask's probes for the type of the result
+        if elements:
+            callback(Call(name, path, dtype, elements, seconds))
+        return result
+    return timed_func
+
+
+class Recorder:
+    """
+    Instrumentation callback that adds up calls, elements and wall time by
+    function, dispatch path and dtype.
+
+    A Recorder can be pickled, so it also works with the processes and
+    distributed schedulers of dask; but the records of dask blocks are then
+    added up by the copies of the recorder in the workers, not by this one.
+
+    Examples
+    --------
+    >>> recorder = fastjmd95.instrument.Recorder()
+    >>> with fastjmd95.set_options(instrument=recorder):
+    ...     rho(s, t, p)
+    >>> recorder.totals
+    {('rho', 'numpy', dtype('float64')): Totals(calls=1, elements=1000, seconds=2.1e-05)}
+    """
+
+    def __init__(self):
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # the lock cannot be pickled, e.g. for the processes scheduler
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __call__(self, call):
+        key = (call.function, call.path, call.dtype)
+        with self._lock:
+            calls, elements, seconds = self.totals.get(key, (0, 0, 0.))
+            self.totals[key] = Totals(calls + 1, elements + call.elements,
+                                      seconds + call.seconds)
+
+    def reset(self):
+        with self._lock:
+            self.totals = {}
@@ -2,10 +2,28 @@
 # created by mlosch on 2002-08-09
 # converted to python by jahn on 2010-04-29
 
+import os
 import sys
+import contextlib
+import functools
+import threading
+import types
 import numpy as np
 
-from numba import vectorize, float64, float32
+import numba
+from numba import vectorize, guvectorize, jit, float64, float32, boolean
+
+from ._dispatch import select_loop, selecting_inputs
+
+# compiled kernels are cached on disk; by default numba picks the location
+# (NUMBA_CACHE_DIR, __pycache__ next to this file, or a user-wide directory
+# if that is read-only), FASTJMD95_CACHE_DIR overrides it for fastjmd95 only
+CACHE_DIR = os.environ.get("FASTJMD95_CACHE_DIR")
+
+# LLVM fast-math flags of the fastmath kernels: reassociation and FMA
+# contraction, but not "nnan"/"ninf", so that NaN (e.g. land) points still
+# propagate
+FASTMATH_FLAGS = frozenset(["contract", "reassoc", "nsz", "arcp", "afn"])
 
 # coefficients nonlinear equation of state in pressure coordinates for
 # 1. density of fresh water at p = 0
@@ -68,11 +86,197 @@ eosJMDCKP = np.array(
     ]
 )
 
+# python functions, signatures and gufunc layouts of all kernels, kept so that
+# they can be compiled again for other targets
+_kernels = {}
 
-@vectorize(
-    [float64(float64, float64, float64), float32(float32, float32, float32)],
-    nopython=True,
-)
+
+# held while numba's global cache directory is changed: kernels compile on
+# first use, possibly from several threads at once (e.g. dask workers)
+_compile_lock = threading.RLock()
+
+
+@contextlib.contextmanager
+def _cache_dir():
+    # numba reads its cache directory when a function is decorated
+    if not CACHE_DIR:
+        yield
+        return
+    with _compile_lock:
+        old = numba.config.CACHE_DIR
+        numba.config.CACHE_DIR = CACHE_DIR
+        try:
+            yield
+        finally:
+            numba.config.CACHE_DIR = old
+
+
+def _jit(func):
+    """ Compile a scalar helper, cached like the kernels and inlined into
+    them, so that fastmath kernels can reassociate across helpers
+    """
+    with _cache_dir():
+        return jit(nopython=True, cache=True, inline="always")(func)
+
+
+def _reduction(func):
+    """ Compile a reduction over flat arrays, cached like the kernels
+    """
+    with _cache_dir():
+        return jit(nopython=True, cache=True)(func)
+
+
+def _compile(func, signatures, layout=None, **options):
+    with _cache_dir():
+        if layout is None:
+            return vectorize(signatures, nopython=True, cache=True, **options)(func)
+        return guvectorize(signatures, layout, nopython=True, cache=True, **options)(
+            func
+        )
+
+
+def _loop_dtypes(signature, layout):
+    # (input dtype, output dtype) of a loop, that of its first output for
+    # gufuncs
+    if layout is None:
+        dtypes = [signature.args[0], signature.return_type]
+    else:
+        nin = layout.split("->")[0].count("(")
+        dtypes = [getattr(signature[0], "dtype", signature[0]), signature[nin].dtype]
+    return tuple(np.dtype(str(d)) for d in dtypes)
+
+
+def _loop_signature(signature, layout):
+    # dtypes of all the arguments of a loop, for numpy's signature=
+    if layout is None:
+        signature = list(signature.args) + [signature.return_type]
+    return tuple(np.dtype(str(getattr(t, "dtype", t))) for t in signature)
+
+
+def _fastmath_copy(func):
+    # numba's cache does not key on fastmath, so the fastmath loops are
+    # compiled from a renamed copy that gets its own cache files
+    copy = types.FunctionType(
+        func.__code__,
+        func.__globals__,
+        func.__name__,
+        func.__defaults__,
+        func.__closure__,
+    )
+    copy.__qualname__ = func.__qualname__ + "_fastmath"
+    copy.__doc__ = func.__doc__
+    return copy
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_loop(name, index, target="cpu", fastmath=False):
+    func, signatures, layout = _kernels[name]
+    with _compile_lock:
+        if fastmath:
+            return _compile(
+                _fastmath_copy(func),
+                [signatures[index]],
+                layout,
+                target=target,
+                fastmath=set(FASTMATH_FLAGS),
+            )
+        return _compile(func, [signatures[index]], layout, target=target)
+
+
+class _LazyKernel:
+    """ A ufunc (or gufunc) whose loops are compiled on first use, one
+    signature at a time
+    """
+
+    def __init__(self, name, target="cpu", fastmath=False):
+        func, signatures, layout = _kernels[name]
+        self.__name__ = name
+        self.__doc__ = func.__doc__
+        self.target = target
+        self.fastmath = fastmath
+        self.loops = [_loop_dtypes(sig, layout) for sig in signatures]
+        self.dtypes = sorted(set(loop[0] for loop in self.loops), key=str)
+        # numpy's dtype= would ask for every output in that dtype, and every
+        # input of gufuncs, so loops with outputs or inputs of several dtypes
+        # are picked with signature= instead
+        self._signatures = [None] * len(signatures)
+        if layout is None:
+            nin = func.__code__.co_argcount
+        else:
+            nin = layout.split("->")[0].count("(")
+        inputs = []
+        for index, sig in enumerate(signatures):
+            dtypes = _loop_signature(sig, layout)
+            if len(set(dtypes[nin:])) > 1 or len(set(dtypes[:nin])) > 1:
+                self._signatures[index] = dtypes
+            inputs.append(dtypes[:nin])
+        self._inputs = selecting_inputs(inputs)
+
+    def compile(self, dtype):
+        """ Compile the loops for inputs of `dtype` and return them
+        """
+        return [
+            _compile_loop(self.__name__, index, self.target, self.fastmath)
+            for index, loop in enumerate(self.loops)
+            if loop[0] == np.dtype(dtype)
+        ]
+
+    def __call__(self, *args, **kwargs):
+        selecting = [args[i] for i in self._inputs if i < len(args)]
+        index = select_loop(self.__name__, self.loops, selecting, kwargs.get("dtype"))
+        loop = _compile_loop(self.__name__, index, self.target, self.fastmath)
+        if kwargs.get("dtype") is not None and self._signatures[index] is not None:
+            del kwargs["dtype"]
+            kwargs["signature"] = self._signatures[index]
+        return loop(*args, **kwargs)
+
+    def __repr__(self):
+        return "<fastjmd95 kernel %r, target=%r, fastmath=%r>" % (
+            self.__name__,
+            self.target,
+            self.fastmath,
+        )
+
+
+def _kernel(signatures, layout=None):
+    """ Register a ufunc (or a gufunc, if a layout is given), to be compiled
+    for each signature on first use
+    """
+
+    def decorator(func):
+        _kernels[func.__name__] = (func, signatures, layout)
+        return _LazyKernel(func.__name__)
+
+    return decorator
+
+
+@functools.lru_cache(maxsize=None)
+def parallel_kernel(name, fastmath=False):
+    """ Multithreaded version of kernel `name`, compiled on first use
+    """
+    return _LazyKernel(name, target="parallel", fastmath=fastmath)
+
+
+@functools.lru_cache(maxsize=None)
+def fastmath_kernel(name):
+    """ Version of kernel `name` compiled with `FASTMATH_FLAGS`, on first use
+    """
+    return _LazyKernel(name, fastmath=True)
+
+
+def warmup(functions=None, dtypes=None, target="cpu", fastmath=False):
+    """ Compile the loops of `functions` (default: all kernels) for inputs of
+    `dtypes` (default: every signature) now rather than on first use
+    """
+    if functions is None:
+        functions = [name for name in _kernels if not name.startswith("_")]
+    for name in functions:
+        kernel = _LazyKernel(name, target=target, fastmath=fastmath)
+        for dtype in kernel.dtypes if dtypes is None else dtypes:
+            kernel.compile(dtype)
+
+
+@_jit
 def _bulkmodjmd95(s, t, p):
     """ Compute bulk modulus
     """
@@ -113,7 +317,7 @@ def _bulkmodjmd95(s, t, p):
     return bulkmod
 
 
-@vectorize([float64(float64, float64), float32(float32, float32)], nopython=True)
+@_jit
 def _rho_s(s, t):
 
     t2 = t * t
@@ -147,9 +351,163 @@ def _rho_s(s, t):
     return rho_s
 
 
-@vectorize(
-    [float64(float64, float64, float64), float32(float32, float32, float32)],
-    nopython=True,
+@_jit
+def _drhodt_terms(s, t, p):
+    """ Temperature derivatives of surface density and bulk modulus;
+    p in bar
+    """
+    p2 = p * p
+    t2 = t * t
+
+    # thermal expansion
+    sqr = np.sqrt(s)
+
+    DRDT0 = (
+        eosJMDCFw[1]
+        + 2 * eosJMDCFw[2] * t
+        + (3 * eosJMDCFw[3] + 4 * eosJMDCFw[4] * t + 5 * eosJMDCFw[5] * t2) * t2
+        + (
+            eosJMDCSw[1]
+            + 2 * eosJMDCSw[2] * t
+            + (3 * eosJMDCSw[3] + 4 * eosJMDCSw[4] * t) * t2
+            + (eosJMDCSw[6] + 2 * eosJMDCSw[7] * t) * sqr
+        )
+        * s
+    )
+    DKDT = (
+        eosJMDCKFw[1]
+        + 2 * eosJMDCKFw[2] * t
+        + (3 * eosJMDCKFw[3] + 4 * eosJMDCKFw[4] * t) * t2
+        + p * (eosJMDCKP[1] + 2 * eosJMDCKP[2] * t + 3 * eosJMDCKP[3] * t)
+        + p2 * (eosJMDCKP[9] + 2 * eosJMDCKP[10] * t)
+        + s
+        * (
+            eosJMDCKSw[1]
+            + 2 * eosJMDCKSw[2] * t
+            + 3 * eosJMDCKSw[3] * t2
+            + p * (eosJMDCKP[5] + 2 * eosJMDCKP[6] * t)
+            + p2 * (eosJMDCKP[12] + 2 * eosJMDCKP[13] * t)
+            + sqr * (eosJMDCKSw[5] + 2 * eosJMDCKSw[6] * t)
+        )
+    )
+    return DRDT0, DKDT
+
+
+@_jit
+def _drhods_terms(s, t, p):
+    """ Salinity derivatives of surface density and bulk modulus;
+    p in bar
+    """
+    p2 = p * p
+    t2 = t * t
+    t3 = t2 * t
+
+    # thermal expansion
+    sqr = np.sqrt(s)
+
+    work1 = (
+        eosJMDCSw[0]
+        + eosJMDCSw[1] * t
+        + (eosJMDCSw[2] + eosJMDCSw[3] * t + eosJMDCSw[4] * t2) * t2
+    )
+    work2 = sqr * (eosJMDCSw[5] + eosJMDCSw[6] * t + eosJMDCSw[7] * t2)
+    work3 = (
+        eosJMDCKSw[0]
+        + eosJMDCKSw[1] * t
+        + (eosJMDCKSw[2] + eosJMDCKSw[3] * t) * t2
+        + p * (eosJMDCKP[4] + eosJMDCKP[5] * t + eosJMDCKP[6] * t2)
+        + p2 * (eosJMDCKP[11] + eosJMDCKP[12] * t + eosJMDCKP[13] * t3)
+    )
+    work4 = sqr * (
+        eosJMDCKSw[4] + eosJMDCKSw[5] * t + eosJMDCKSw[6] * t2 + eosJMDCKP[7] * p
+    )
+
+    # didn't work for some reason
+    #     bulk_mod = (
+    #         eosJMDCKFw[9]
+    #         + eosJMDCKFw[1] * t
+    #         + (eosJMDCKFw[2] + eosJMDCKFw[3] * t + eosJMDCKFw[4] * t2) * t2
+    #         + p * (eosJMDCKP[0] + eosJMDCKP[1] * t + (eosJMDCKP[2] + eosJMDCKP[3] * t) * t2)
+    #         + p2 * (eosJMDCKP[8] + eosJMDCKP[9] * t + eosJMDCKP[10] * t2)
+    #         + s * (work3 + work4)
+    #     )
+
+    drds0 = 2 * eosJMDCSw[8] * s + work1 + 1.5 * work2
+    dkds = work3 + 1.5 * work4
+    return drds0, dkds
+
+
+@_jit
+def _rho_and_derivatives(s, t, p):
+    """ Density and its temperature and salinity derivatives, sharing the
+    surface density and bulk modulus; p in dbar
+    """
+    # evaluate in float64 whatever the dtype of the inputs and outputs
+    s, t, p = np.float64(s), np.float64(t), np.float64(p)
+    p = 0.1 * p
+    rho_s = _rho_s(s, t)
+    bulk_mod = _bulkmodjmd95(s, t, p)
+    denomk = 1.0 / (bulk_mod - p)
+
+    DRDT0, DKDT = _drhodt_terms(s, t, p)
+    drds0, dkds = _drhods_terms(s, t, p)
+
+    rho = rho_s / (1.0 - p / bulk_mod)
+    DRHODT = denomk * (DRDT0 * bulk_mod - p * rho_s * DKDT * denomk)
+    DRHODS = denomk * (drds0 * bulk_mod - p * rho_s * dkds * denomk)
+    return rho, DRHODT, DRHODS
+
+
+@_jit
+def _rho(s, t, p):
+    """ In-situ density; p in dbar
+    """
+    # convert pressure to bar
+    p = 0.1 * p
+
+    # density of freshwater at the surface
+    rho_s = _rho_s(s, t)
+
+    bulk_mod = _bulkmodjmd95(s, t, p)
+    # the pop formumlation
+    # rho = rho_s * bulk_mod * denomk
+    # original formulation
+    rho = rho_s / (1.0 - p / bulk_mod)
+    return rho
+
+
+@_jit
+def _drhodt(s, t, p):
+    """ Temperature derivative of density; p in dbar
+    """
+    p = 0.1 * p
+    rho_s = _rho_s(s, t)
+    bulk_mod = _bulkmodjmd95(s, t, p)
+    DRDT0, DKDT = _drhodt_terms(s, t, p)
+    denomk = 1.0 / (bulk_mod - p)
+    DRHODT = denomk * (DRDT0 * bulk_mod - p * rho_s * DKDT * denomk)
+    return DRHODT
+
+
+@_jit
+def _drhods(s, t, p):
+    """ Salinity derivative of density; p in dbar
+    """
+    p = 0.1 * p
+    rho_s = _rho_s(s, t)
+    bulk_mod = _bulkmodjmd95(s, t, p)
+    drds0, dkds = _drhods_terms(s, t, p)
+    denomk = 1.0 / (bulk_mod - p)
+    drhods = denomk * (drds0 * bulk_mod - p * rho_s * dkds * denomk)
+    return drhods
+
+
+@_kernel(
+    [
+        float64(float64, float64, float64),
+        float32(float32, float32, float32),
+        float64(float32, float32, float32),
+    ]
 )
 def rho(s, t, p):
     """
@@ -185,23 +543,17 @@ def rho(s, t, p):
     Technol., 12, 381–389, https://doi.org/10.1175/1520-0426(1995)012<0381:MAOHPT>2.0.CO;2
     """
 
-    # convert pressure to bar
-    p = 0.1 * p
-
-    # density of freshwater at the surface
-    rho_s = _rho_s(s, t)
-
-    bulk_mod = _bulkmodjmd95(s, t, p)
-    # the pop formumlation
-    # rho = rho_s * bulk_mod * denomk
-    # original formulation
-    rho = rho_s / (1.0 - p / bulk_mod)
-    return rho
+    # evaluate in float64 whatever the dtype of the inputs and outputs
+    s, t, p = np.float64(s), np.float64(t), np.float64(p)
+    return _rho(s, t, p)
 
 
-@vectorize(
-    [float64(float64, float64, float64), float32(float32, float32, float32)],
-    nopython=True,
+@_kernel(
+    [
+        float64(float64, float64, float64),
+        float32(float32, float32, float32),
+        float64(float32, float32, float32),
+    ]
 )
 def drhodt(s, t, p):
     """
@@ -237,53 +589,17 @@ def drhodt(s, t, p):
     Hydrographic Profiles to Achieve Static Stability. J. Atmos. Oceanic
     Technol., 12, 381–389, https://doi.org/10.1175/1520-0426(1995)012<0381:MAOHPT>2.0.CO;2
     """
-    p = 0.1 * p
-    p2 = p * p
-    t2 = t * t
-
-    # thermal expansion
-    sqr = np.sqrt(s)
-
-    DRDT0 = (
-        eosJMDCFw[1]
-        + 2 * eosJMDCFw[2] * t
-        + (3 * eosJMDCFw[3] + 4 * eosJMDCFw[4] * t + 5 * eosJMDCFw[5] * t2) * t2
-        + (
-            eosJMDCSw[1]
-            + 2 * eosJMDCSw[2] * t
-            + (3 * eosJMDCSw[3] + 4 * eosJMDCSw[4] * t) * t2
-            + (eosJMDCSw[6] + 2 * eosJMDCSw[7] * t) * sqr
-        )
-        * s
-    )
-    DKDT = (
-        eosJMDCKFw[1]
-        + 2 * eosJMDCKFw[2] * t
-        + (3 * eosJMDCKFw[3] + 4 * eosJMDCKFw[4] * t) * t2
-        + p * (eosJMDCKP[1] + 2 * eosJMDCKP[2] * t + 3 * eosJMDCKP[3] * t)
-        + p2 * (eosJMDCKP[9] + 2 * eosJMDCKP[10] * t)
-        + s
-        * (
-            eosJMDCKSw[1]
-            + 2 * eosJMDCKSw[2] * t
-            + 3 * eosJMDCKSw[3] * t2
-            + p * (eosJMDCKP[5] + 2 * eosJMDCKP[6] * t)
-            + p2 * (eosJMDCKP[12] + 2 * eosJMDCKP[13] * t)
-            + sqr * (eosJMDCKSw[5] + 2 * eosJMDCKSw[6] * t)
-        )
-    )
-
-    rho_s = _rho_s(s, t)
-    bulk_mod = _bulkmodjmd95(s, t, p)
-    denomk = 1.0 / (bulk_mod - p)
-    DRHODT = denomk * (DRDT0 * bulk_mod - p * rho_s * DKDT * denomk)
-    return DRHODT
-    # return rho, DRHODT
+    # evaluate in float64 whatever the dtype of the inputs and outputs
+    s, t, p = np.float64(s), np.float64(t), np.float64(p)
+    return _drhodt(s, t, p)
 
 
-@vectorize(
-    [float64(float64, float64, float64), float32(float32, float32, float32)],
-    nopython=True,
+@_kernel(
+    [
+        float64(float64, float64, float64),
+        float32(float32, float32, float32),
+        float64(float32, float32, float32),
+    ]
 )
 def drhods(s, t, p):
     """
@@ -320,47 +636,835 @@ def drhods(s, t, p):
     Technol., 12, 381–389, https://doi.org/10.1175/1520-0426(1995)012<0381:MAOHPT>2.0.CO;2
     """
 
-    p = 0.1 * p
-    p2 = p * p
-    t2 = t * t
-    t3 = t2 * t
+    # evaluate in float64 whatever the dtype of the inputs and outputs
+    s, t, p = np.float64(s), np.float64(t), np.float64(p)
+    return _drhods(s, t, p)
 
-    # thermal expansion
-    sqr = np.sqrt(s)
 
-    work1 = (
-        eosJMDCSw[0]
-        + eosJMDCSw[1] * t
-        + (eosJMDCSw[2] + eosJMDCSw[3] * t + eosJMDCSw[4] * t2) * t2
-    )
-    work2 = sqr * (eosJMDCSw[5] + eosJMDCSw[6] * t + eosJMDCSw[7] * t2)
-    work3 = (
-        eosJMDCKSw[0]
-        + eosJMDCKSw[1] * t
-        + (eosJMDCKSw[2] + eosJMDCKSw[3] * t) * t2
-        + p * (eosJMDCKP[4] + eosJMDCKP[5] * t + eosJMDCKP[6] * t2)
-        + p2 * (eosJMDCKP[11] + eosJMDCKP[12] * t + eosJMDCKP[13] * t3)
-    )
-    work4 = sqr * (
-        eosJMDCKSw[4] + eosJMDCKSw[5] * t + eosJMDCKSw[6] * t2 + eosJMDCKP[7] * p
-    )
+@_kernel(
+    [
+        (float64, float64, float64, float64[:], float64[:], float64[:]),
+        (float32, float32, float32, float32[:], float32[:], float32[:]),
+        (float32, float32, float32, float64[:], float64[:], float64[:]),
+    ],
+    "(),(),()->(),(),()",
+)
+def rho_and_derivatives(s, t, p, rho_out, drhodt_out, drhods_out):
+    """
+    Computes in-situ density and its partial derivatives with respect to
+    potential temperature and practical salinity in a single pass, using
+    Jackett and McDougall 1995 polynomial [1]_.
 
-    # didn't work for some reason
-    #     bulk_mod = (
-    #         eosJMDCKFw[9]
-    #         + eosJMDCKFw[1] * t
-    #         + (eosJMDCKFw[2] + eosJMDCKFw[3] * t + eosJMDCKFw[4] * t2) * t2
-    #         + p * (eosJMDCKP[0] + eosJMDCKP[1] * t + (eosJMDCKP[2] + eosJMDCKP[3] * t) * t2)
-    #         + p2 * (eosJMDCKP[8] + eosJMDCKP[9] * t + eosJMDCKP[10] * t2)
-    #         + s * (work3 + work4)
-    #     )
+    Parameters
+    ----------
+    s : array_like
+        practical salinity [psu (PSS-78)]
+    t : array_like
+        potential temperature [degree C (IPTS-68)];
+        same shape as s
+    p : array_like
+        pressure [dbar]; broadcastable to shape of s
 
-    bulk_mod = _bulkmodjmd95(s, t, p)
-    denomk = 1.0 / (bulk_mod - p)
+    Returns
+    -------
+    rho : array
+        density [kg/m^3]
+    drhodt : array
+        partial derivative of density with respect to potential temperature
+        [kg/m^3/deg C]
+    drhods : array
+        partial derivative of density with respect to practical salinity
+        [kg/m^3/psu]
 
-    drds0 = 2 * eosJMDCSw[8] * s + work1 + 1.5 * work2
-    dkds = work3 + 1.5 * work4
+    Example
+    -------
+    >>> rho_and_derivatives(35.5, 3., 3000.)
+    (1041.83267, -0.17244, 0.77481)
+
+    Notes
+    -----
+    Equivalent to calling `rho`, `drhodt` and `drhods`, but each input is
+    read once and the surface density and bulk modulus are shared.
+
+    .. [1] Jackett, D.R. and T.J. Mcdougall, 1995: Minimal Adjustment of
+    Hydrographic Profiles to Achieve Static Stability. J. Atmos. Oceanic
+    Technol., 12, 381–389, https://doi.org/10.1175/1520-0426(1995)012<0381:MAOHPT>2.0.CO;2
+    """
+    rho_out[0], drhodt_out[0], drhods_out[0] = _rho_and_derivatives(s, t, p)
+
+
+@_kernel(
+    [
+        float64(float64, float64, float64),
+        float32(float32, float32, float32),
+        float64(float32, float32, float32),
+    ]
+)
+def alpha(s, t, p):
+    """
+    Computes the thermal expansion coefficient of sea water using Jackett and
+    McDougall 1995 polynomial [1]_.
+
+    Parameters
+    ----------
+    s : array_like
+        practical salinity [psu (PSS-78)]
+    t : array_like
+        potential temperature [degree C (IPTS-68)];
+        same shape as s
+    p : array_like
+        pressure [dbar]; broadcastable to shape of s
+
+    Returns
+    -------
+    alpha : array
+        thermal expansion coefficient, -1/rho * drho/dt [1/deg C]
+
+    Example
+    -------
+    >>> alpha(35.5, 3., 3000.)
+    0.000165516
+
+    Notes
+    -----
+    .. [1] Jackett, D.R. and T.J. Mcdougall, 1995: Minimal Adjustment of
+    Hydrographic Profiles to Achieve Static Stability. J. Atmos. Oceanic
+    Technol., 12, 381–389, https://doi.org/10.1175/1520-0426(1995)012<0381:MAOHPT>2.0.CO;2
+    """
+    rho, DRHODT, DRHODS = _rho_and_derivatives(s, t, p)
+    return -DRHODT / rho
+
+
+@_kernel(
+    [
+        float64(float64, float64, float64),
+        float32(float32, float32, float32),
+        float64(float32, float32, float32),
+    ]
+)
+def beta(s, t, p):
+    """
+    Computes the haline contraction coefficient of sea water using Jackett and
+    McDougall 1995 polynomial [1]_.
+
+    Parameters
+    ----------
+    s : array_like
+        practical salinity [psu (PSS-78)]
+    t : array_like
+        potential temperature [degree C (IPTS-68)];
+        same shape as s
+    p : array_like
+        pressure [dbar]; broadcastable to shape of s
+
+    Returns
+    -------
+    beta : array
+        haline contraction coefficient, 1/rho * drho/ds [1/psu]
+
+    Example
+    -------
+    >>> beta(35.5, 3., 3000.)
+    0.000743700
+
+    Notes
+    -----
+    .. [1] Jackett, D.R. and T.J. Mcdougall, 1995: Minimal Adjustment of
+    Hydrographic Profiles to Achieve Static Stability. J. Atmos. Oceanic
+    Technol., 12, 381–389, https://doi.org/10.1175/1520-0426(1995)012<0381:MAOHPT>2.0.CO;2
+    """
+    rho, DRHODT, DRHODS = _rho_and_derivatives(s, t, p)
+    return DRHODS / rho
+
+
+@_kernel(
+    [
+        (float64, float64, float64, float64[:], float64[:]),
+        (float32, float32, float32, float32[:], float32[:]),
+        (float32, float32, float32, float64[:], float64[:]),
+    ],
+    "(),(),()->(),()",
+)
+def alpha_beta(s, t, p, alpha_out, beta_out):
+    """
+    Computes the thermal expansion and haline contraction coefficients of sea
+    water in a single pass, using Jackett and McDougall 1995 polynomial [1]_.
+
+    Parameters
+    ----------
+    s : array_like
+        practical salinity [psu (PSS-78)]
+    t : array_like
+        potential temperature [degree C (IPTS-68)];
+        same shape as s
+    p : array_like
+        pressure [dbar]; broadcastable to shape of s
+
+    Returns
+    -------
+    alpha : array
+        thermal expansion coefficient, -1/rho * drho/dt [1/deg C]
+    beta : array
+        haline contraction coefficient, 1/rho * drho/ds [1/psu]
+
+    Example
+    -------
+    >>> alpha_beta(35.5, 3., 3000.)
+    (0.000165516, 0.000743700)
+
+    Notes
+    -----
+    .. [1] Jackett, D.R. and T.J. Mcdougall, 1995: Minimal Adjustment of
+    Hydrographic Profiles to Achieve Static Stability. J. Atmos. Oceanic
+    Technol., 12, 381–389, https://doi.org/10.1175/1520-0426(1995)012<0381:MAOHPT>2.0.CO;2
+    """
+    rho, DRHODT, DRHODS = _rho_and_derivatives(s, t, p)
+    alpha_out[0] = -DRHODT / rho
+    beta_out[0] = DRHODS / rho
+
+
+# loops of the fused kernels of two of rho, drhodt and drhods, for
+# `eos_fields`; the compiler leaves out the terms of the third
+_PAIR_SIGNATURES = [
+    (float64, float64, float64, float64[:], float64[:]),
+    (float32, float32, float32, float32[:], float32[:]),
+    (float32, float32, float32, float64[:], float64[:]),
+]
+
+
+@_kernel(_PAIR_SIGNATURES, "(),(),()->(),()")
+def _rho_and_drhodt(s, t, p, rho_out, drhodt_out):
+    """ Density and its temperature derivative
+    """
+    rho_out[0], drhodt_out[0], _ = _rho_and_derivatives(s, t, p)
+
+
+@_kernel(_PAIR_SIGNATURES, "(),(),()->(),()")
+def _rho_and_drhods(s, t, p, rho_out, drhods_out):
+    """ Density and its salinity derivative
+    """
+    rho_out[0], _, drhods_out[0] = _rho_and_derivatives(s, t, p)
+
+
+@_kernel(_PAIR_SIGNATURES, "(),(),()->(),()")
+def _drhodt_and_drhods(s, t, p, drhodt_out, drhods_out):
+    """ Temperature and salinity derivatives of density
+    """
+    _, drhodt_out[0], drhods_out[0] = _rho_and_derivatives(s, t, p)
+
+
+def level_coefficients(p):
+    """
+    Collapses the pressure dependent terms of the bulk modulus for each
+    pressure level, for `rho_levels`.
+
+    At a fixed pressure the bulk modulus is
+    ``A(t) + s * B(t) + s**1.5 * C(t)`` with polynomials A, B and C in t
+    whose coefficients ``a0-a3, b0-b2, c0`` depend on pressure.
+
+    Parameters
+    ----------
+    p : array_like
+        pressure of each level [dbar]
+
+    Returns
+    -------
+    coefficients : array
+        shape ``(9,) + p.shape``: the pressure in bar, then
+        ``a0, a1, a2, a3, b0, b1, b2, c0``
+    """
+    p = 0.1 * np.asarray(p, dtype=np.float64)
+    p2 = p * p
+    return np.array(
+        [
+            p,
+            eosJMDCKFw[0] + p * eosJMDCKP[0] + p2 * eosJMDCKP[8],
+            eosJMDCKFw[1] + p * eosJMDCKP[1] + p2 * eosJMDCKP[9],
+            eosJMDCKFw[2] + p * eosJMDCKP[2] + p2 * eosJMDCKP[10],
+            eosJMDCKFw[3] + p * eosJMDCKP[3],
+            eosJMDCKSw[0] + p * eosJMDCKP[4] + p2 * eosJMDCKP[11],
+            eosJMDCKSw[1] + p * eosJMDCKP[5] + p2 * eosJMDCKP[12],
+            eosJMDCKSw[2] + p * eosJMDCKP[6] + p2 * eosJMDCKP[13],
+            eosJMDCKSw[4] + p * eosJMDCKP[7],
+        ]
+    )
+
+
+@_jit
+def _bulkmod_level(s, t, a0, a1, a2, a3, b0, b1, b2, c0):
+    """ Bulk modulus from the coefficients of a pressure level
+    """
+    s3o2 = s * np.sqrt(s)
+    return (
+        a0
+        + t * (a1 + t * (a2 + t * (a3 + t * eosJMDCKFw[4])))
+        + s * (b0 + t * (b1 + t * (b2 + t * eosJMDCKSw[3])))
+        + s3o2 * (c0 + t * (eosJMDCKSw[5] + t * eosJMDCKSw[6]))
+    )
+
+
+@_kernel(
+    [
+        float64(*[float64] * 11),
+        float32(float32, float32, *[float64] * 9),
+        float64(float32, float32, *[float64] * 9),
+    ]
+)
+def rho_levels(s, t, p, a0, a1, a2, a3, b0, b1, b2, c0):
+    """
+    Computes in-situ density using Jackett and McDougall 1995 polynomial,
+    with the pressure dependent terms of the bulk modulus collapsed into
+    coefficients of the level, see `level_coefficients`.
+
+    Parameters
+    ----------
+    s : array_like
+        practical salinity [psu (PSS-78)]
+    t : array_like
+        potential temperature [degree C (IPTS-68)];
+        same shape as s
+    p, a0, a1, a2, a3, b0, b1, b2, c0 : array_like
+        pressure [bar] and bulk modulus coefficients of the level, in
+        float64 whatever the dtype of s and t; broadcastable to shape of s
+
+    Returns
+    -------
+    dens : array
+        density [kg/m^3]
+    """
+    # evaluate in float64 whatever the dtype of the inputs and outputs
+    s, t = np.float64(s), np.float64(t)
+    bulk_mod = _bulkmod_level(s, t, a0, a1, a2, a3, b0, b1, b2, c0)
     rho_s = _rho_s(s, t)
-    drhods = denomk * (drds0 * bulk_mod - p * rho_s * dkds * denomk)
-    return drhods
-    # return bulk_mod
+    return rho_s / (1.0 - p / bulk_mod)
+
+
+# density [kg/m^3] and gravity [m/s^2] of the hydrostatic depth to pressure
+# conversion without latitude, as in MITgcm setups such as ECCO/LLC
+RHO_CONST = 1029.0
+GRAVITY = 9.81
+
+
+@_jit
+def _pressure_at_depth(z, lat):
+    """ Pressure [dbar] at depth z [m, either sign]: Saunders (1981) at
+    latitude lat [degrees north], or hydrostatic with density RHO_CONST if
+    lat is NaN
+    """
+    z = abs(z)
+    if np.isnan(lat):
+        return RHO_CONST * GRAVITY * 1e-4 * z
+    x = np.sin(np.deg2rad(lat))
+    c1 = 5.92e-3 + 5.25e-3 * x * x
+    return ((1.0 - c1) - np.sqrt((1.0 - c1) ** 2 - 8.84e-6 * z)) / 4.42e-6
+
+
+_DEPTH_SIGNATURES = [
+    float64(float64, float64, float64, float64),
+    float32(float32, float32, float32, float32),
+    float64(float32, float32, float32, float32),
+]
+
+
+@_kernel(_DEPTH_SIGNATURES)
+def rho_z(s, t, z, lat):
+    """
+    Computes in-situ density like `rho`, at depth `z` rather than pressure.
+
+    Parameters
+    ----------
+    s : array_like
+        practical salinity [psu (PSS-78)]
+    t : array_like
+        potential temperature [degree C (IPTS-68)];
+        same shape as s
+    z : array_like
+        depth [m]; its sign is ignored, so heights (negative below the
+        surface, like MITgcm's ``Z``) work too
+    lat : array_like
+        latitude [degrees north] for the pressure of Saunders (1981), or NaN
+        for hydrostatic pressure ``RHO_CONST * GRAVITY * |z|``
+
+    Returns
+    -------
+    dens : array
+        density [kg/m^3]
+
+    Notes
+    -----
+    Saunders, P. M., 1981: Practical conversion of pressure to depth.
+    J. Phys. Oceanogr., 11, 573–574,
+    https://doi.org/10.1175/1520-0485(1981)011<0573:PCOPTD>2.0.CO;2
+    """
+    # evaluate in float64 whatever the dtype of the inputs and outputs
+    s, t, z, lat = np.float64(s), np.float64(t), np.float64(z), np.float64(lat)
+    return _rho(s, t, _pressure_at_depth(z, lat))
+
+
+@_kernel(_DEPTH_SIGNATURES)
+def drhodt_z(s, t, z, lat):
+    """
+    Computes the temperature derivative of density like `drhodt`, at depth
+    `z` rather than pressure; see `rho_z`.
+    """
+    s, t, z, lat = np.float64(s), np.float64(t), np.float64(z), np.float64(lat)
+    return _drhodt(s, t, _pressure_at_depth(z, lat))
+
+
+@_kernel(_DEPTH_SIGNATURES)
+def drhods_z(s, t, z, lat):
+    """
+    Computes the salinity derivative of density like `drhods`, at depth `z`
+    rather than pressure; see `rho_z`.
+    """
+    s, t, z, lat = np.float64(s), np.float64(t), np.float64(z), np.float64(lat)
+    return _drhods(s, t, _pressure_at_depth(z, lat))
+
+
+@_kernel(_DEPTH_SIGNATURES)
+def alpha_z(s, t, z, lat):
+    """
+    Computes the thermal expansion coefficient like `alpha`, at depth `z`
+    rather than pressure; see `rho_z`.
+    """
+    s, t, z, lat = np.float64(s), np.float64(t), np.float64(z), np.float64(lat)
+    rho, DRHODT, DRHODS = _rho_and_derivatives(s, t, _pressure_at_depth(z, lat))
+    return -DRHODT / rho
+
+
+@_kernel(_DEPTH_SIGNATURES)
+def beta_z(s, t, z, lat):
+    """
+    Computes the haline contraction coefficient like `beta`, at depth `z`
+    rather than pressure; see `rho_z`.
+    """
+    s, t, z, lat = np.float64(s), np.float64(t), np.float64(z), np.float64(lat)
+    rho, DRHODT, DRHODS = _rho_and_derivatives(s, t, _pressure_at_depth(z, lat))
+    return DRHODS / rho
+
+
+@_kernel(
+    [
+        (float64, float64, float64, float64, float64[:], float64[:], float64[:]),
+        (float32, float32, float32, float32, float32[:], float32[:], float32[:]),
+        (float32, float32, float32, float32, float64[:], float64[:], float64[:]),
+    ],
+    "(),(),(),()->(),(),()",
+)
+def rho_and_derivatives_z(s, t, z, lat, rho_out, drhodt_out, drhods_out):
+    """
+    Computes in-situ density and its derivatives like `rho_and_derivatives`,
+    at depth `z` rather than pressure; see `rho_z`.
+    """
+    s, t, z, lat = np.float64(s), np.float64(t), np.float64(z), np.float64(lat)
+    p = _pressure_at_depth(z, lat)
+    rho_out[0], drhodt_out[0], drhods_out[0] = _rho_and_derivatives(s, t, p)
+
+
+# loops of the fused kernels of two fields at depth
+_DEPTH_PAIR_SIGNATURES = [
+    (float64, float64, float64, float64, float64[:], float64[:]),
+    (float32, float32, float32, float32, float32[:], float32[:]),
+    (float32, float32, float32, float32, float64[:], float64[:]),
+]
+
+
+@_kernel(_DEPTH_PAIR_SIGNATURES, "(),(),(),()->(),()")
+def alpha_beta_z(s, t, z, lat, alpha_out, beta_out):
+    """
+    Computes the thermal expansion and haline contraction coefficients like
+    `alpha_beta`, at depth `z` rather than pressure; see `rho_z`.
+    """
+    s, t, z, lat = np.float64(s), np.float64(t), np.float64(z), np.float64(lat)
+    rho, DRHODT, DRHODS = _rho_and_derivatives(s, t, _pressure_at_depth(z, lat))
+    alpha_out[0] = -DRHODT / rho
+    beta_out[0] = DRHODS / rho
+
+
+@_kernel(_DEPTH_PAIR_SIGNATURES, "(),(),(),()->(),()")
+def _rho_and_drhodt_z(s, t, z, lat, rho_out, drhodt_out):
+    """ Density and its temperature derivative at depth
+    """
+    s, t, z, lat = np.float64(s), np.float64(t), np.float64(z), np.float64(lat)
+    p = _pressure_at_depth(z, lat)
+    rho_out[0], drhodt_out[0], _ = _rho_and_derivatives(s, t, p)
+
+
+@_kernel(_DEPTH_PAIR_SIGNATURES, "(),(),(),()->(),()")
+def _rho_and_drhods_z(s, t, z, lat, rho_out, drhods_out):
+    """ Density and its salinity derivative at depth
+    """
+    s, t, z, lat = np.float64(s), np.float64(t), np.float64(z), np.float64(lat)
+    p = _pressure_at_depth(z, lat)
+    rho_out[0], _, drhods_out[0] = _rho_and_derivatives(s, t, p)
+
+
+@_kernel(_DEPTH_PAIR_SIGNATURES, "(),(),(),()->(),()")
+def _drhodt_and_drhods_z(s, t, z, lat, drhodt_out, drhods_out):
+    """ Temperature and salinity derivatives of density at depth
+    """
+    s, t, z, lat = np.float64(s), np.float64(t), np.float64(z), np.float64(lat)
+    p = _pressure_at_depth(z, lat)
+    _, drhodt_out[0], drhods_out[0] = _rho_and_derivatives(s, t, p)
+
+
+_SIGMA_DOC = """
+    Computes potential density anomaly ``rho - 1000`` referenced to %g dbar
+    using Jackett and McDougall 1995 polynomial.
+
+    Parameters
+    ----------
+    s : array_like
+        practical salinity [psu (PSS-78)]
+    t : array_like
+        potential temperature [degree C (IPTS-68)];
+        same shape as s
+
+    Returns
+    -------
+    sigma : array
+        potential density anomaly [kg/m^3]
+    """
+
+
+def _sigma_kernel(name, pref):
+    """ Register kernel `name` computing potential density anomaly referenced
+    to `pref` [dbar], with the reference pressure terms compiled in as
+    constants
+    """
+    p, a0, a1, a2, a3, b0, b1, b2, c0 = [float(c) for c in level_coefficients(pref)]
+
+    def sigma(s, t):
+        # evaluate in float64 whatever the dtype of the inputs and outputs
+        s, t = np.float64(s), np.float64(t)
+        bulk_mod = _bulkmod_level(s, t, a0, a1, a2, a3, b0, b1, b2, c0)
+        # the anomaly is taken in float64, so float32 results keep its digits
+        return _rho_s(s, t) / (1.0 - p / bulk_mod) - 1000.0
+
+    sigma.__name__ = sigma.__qualname__ = name
+    sigma.__doc__ = _SIGMA_DOC % pref
+    return _kernel(
+        [
+            float64(float64, float64),
+            float32(float32, float32),
+            float64(float32, float32),
+        ]
+    )(sigma)
+
+
+# reference pressures [dbar] of the potential density kernels
+SIGMA_PRESSURES = {"sigma%d" % n: 1000.0 * n for n in range(5)}
+
+sigma0 = _sigma_kernel("sigma0", SIGMA_PRESSURES["sigma0"])
+sigma1 = _sigma_kernel("sigma1", SIGMA_PRESSURES["sigma1"])
+sigma2 = _sigma_kernel("sigma2", SIGMA_PRESSURES["sigma2"])
+sigma3 = _sigma_kernel("sigma3", SIGMA_PRESSURES["sigma3"])
+sigma4 = _sigma_kernel("sigma4", SIGMA_PRESSURES["sigma4"])
+
+
+@_kernel(
+    [
+        float64(float64, float64, float64),
+        float32(float32, float32, float32),
+        float64(float32, float32, float32),
+    ]
+)
+def sigma(s, t, pref):
+    """
+    Computes potential density anomaly ``rho - 1000`` referenced to any
+    pressure `pref` [dbar], broadcastable to shape of s; the kernels
+    `sigma0` to `sigma4` are faster for their reference pressures.
+    """
+    s, t, pref = np.float64(s), np.float64(t), np.float64(pref)
+    return _rho(s, t, pref) - 1000.0
+
+
+@_kernel(
+    [
+        (float64[:], float64[:], float64[:], float64[:], float64[:]),
+        (float32[:], float32[:], float32[:], float32[:], float32[:]),
+        (float32[:], float32[:], float32[:], float32[:], float64[:]),
+    ],
+    "(n),(n),(n),(m)->(m)",
+)
+def n2(s, t, p, dz, out):
+    """
+    Computes the squared buoyancy frequency at the m = n - 1 interfaces of a
+    column of n levels, from the difference of the densities of the levels
+    above and below each interface, both referenced to its pressure.
+
+    Parameters
+    ----------
+    s : array_like
+        practical salinity [psu (PSS-78)] of the levels, from the top down
+    t : array_like
+        potential temperature [degree C (IPTS-68)] of the levels
+    p : array_like
+        pressure [dbar] of the levels
+    dz : array_like
+        distance [m] between consecutive levels
+
+    Returns
+    -------
+    n2 : array
+        squared buoyancy frequency, ``GRAVITY / rho * drho/dz`` [1/s^2], at
+        the interfaces
+    """
+    # the surface density of each level is used for both of its interfaces
+    s_up, t_up = np.float64(s[0]), np.float64(t[0])
+    rho_s_up = _rho_s(s_up, t_up)
+    for k in range(out.shape[0]):
+        s_dn, t_dn = np.float64(s[k + 1]), np.float64(t[k + 1])
+        rho_s_dn = _rho_s(s_dn, t_dn)
+        # interface pressure [bar]
+        p_mid = 0.05 * (np.float64(p[k]) + np.float64(p[k + 1]))
+        rho_up = rho_s_up / (1.0 - p_mid / _bulkmodjmd95(s_up, t_up, p_mid))
+        rho_dn = rho_s_dn / (1.0 - p_mid / _bulkmodjmd95(s_dn, t_dn, p_mid))
+        out[k] = (
+            GRAVITY * (rho_dn - rho_up) / (0.5 * (rho_up + rho_dn) * np.float64(dz[k]))
+        )
+        s_up, t_up, rho_s_up = s_dn, t_dn, rho_s_dn
+
+
+# iterations and step [degree C or psu] at which the Newton solvers stop
+NEWTON_MAXITER = 20
+NEWTON_TOL = 1e-8
+# first guesses and bounds of the iterates
+THETA_GUESS, THETA_MIN, THETA_MAX = 10.0, -5.0, 50.0
+S_GUESS, S_MIN, S_MAX = 35.0, 0.0, 50.0
+
+
+@_kernel(
+    [
+        (float64, float64, float64, float64[:], boolean[:]),
+        (float32, float32, float32, float32[:], boolean[:]),
+        (float32, float32, float32, float64[:], boolean[:]),
+    ],
+    "(),(),()->(),()",
+)
+def theta_from_rho(rho, s, p, theta_out, converged_out):
+    """
+    Computes potential temperature from in-situ density, salinity and
+    pressure, inverting `rho` with Newton's method, `drhodt` being the exact
+    derivative.
+
+    Iterates start from THETA_GUESS and are kept within THETA_MIN and
+    THETA_MAX. They stop when a step is below NEWTON_TOL, or after
+    NEWTON_MAXITER steps.
+
+    Parameters
+    ----------
+    rho : array_like
+        density [kg/m^3]
+    s : array_like
+        practical salinity [psu (PSS-78)];
+        broadcastable to shape of rho
+    p : array_like
+        pressure [dbar]; broadcastable to shape of rho
+
+    Returns
+    -------
+    theta : array
+        potential temperature [degree C (IPTS-68)]; the last iterate where
+        the solver did not converge, NaN where an input is NaN
+    converged : array of bool
+        whether the solver converged
+
+    Example
+    -------
+    >>> theta_from_rho(1041.83267, 35.5, 3000.)
+    (3.0, True)
+    """
+    rho, s, p = np.float64(rho), np.float64(s), np.float64(p)
+    theta = THETA_GUESS
+    converged = False
+    for _ in range(NEWTON_MAXITER):
+        step = (_rho(s, theta, p) - rho) / _drhodt(s, theta, p)
+        if np.isnan(step):
+            theta = np.nan
+            break
+        theta = min(max(theta - step, THETA_MIN), THETA_MAX)
+        if abs(step) < NEWTON_TOL:
+            converged = True
+            break
+    theta_out[0] = theta
+    converged_out[0] = converged
+
+
+@_kernel(
+    [
+        (float64, float64, float64, float64[:], boolean[:]),
+        (float32, float32, float32, float32[:], boolean[:]),
+        (float32, float32, float32, float64[:], boolean[:]),
+    ],
+    "(),(),()->(),()",
+)
+def s_from_rho(rho, t, p, s_out, converged_out):
+    """
+    Computes salinity from in-situ density, potential temperature and
+    pressure, inverting `rho` with Newton's method, `drhods` being the exact
+    derivative.
+
+    Iterates start from S_GUESS and are kept within S_MIN and S_MAX; they
+    stop as for `theta_from_rho`.
+
+    Parameters
+    ----------
+    rho : array_like
+        density [kg/m^3]
+    t : array_like
+        potential temperature [degree C (IPTS-68)];
+        broadcastable to shape of rho
+    p : array_like
+        pressure [dbar]; broadcastable to shape of rho
+
+    Returns
+    -------
+    s : array
+        practical salinity [psu (PSS-78)]; the last iterate where the solver
+        did not converge, NaN where an input is NaN
+    converged : array of bool
+        whether the solver converged
+
+    Example
+    -------
+    >>> s_from_rho(1041.83267, 3., 3000.)
+    (35.5, True)
+    """
+    rho, t, p = np.float64(rho), np.float64(t), np.float64(p)
+    s = S_GUESS
+    converged = False
+    for _ in range(NEWTON_MAXITER):
+        step = (_rho(s, t, p) - rho) / _drhods(s, t, p)
+        if np.isnan(step):
+            s = np.nan
+            break
+        s = min(max(s - step, S_MIN), S_MAX)
+        if abs(step) < NEWTON_TOL:
+            converged = True
+            break
+    s_out[0] = s
+    converged_out[0] = converged
+
+
+@_kernel(
+    [
+        (float64[:], float64[:], float64[:], float64[:], float64[:], float64[:]),
+        (float32[:], float32[:], float32[:], float64[:], float64[:], float32[:]),
+        (float32[:], float32[:], float32[:], float64[:], float64[:], float64[:]),
+    ],
+    "(n),(n),(n),(c),(k)->(k)",
+)
+def remap_to_density(field, s, t, coefficients, targets, out):
+    """
+    Interpolates a field of a column of n levels linearly onto k surfaces of
+    potential density, evaluated level by level during the column walk.
+
+    Each target is taken at its first crossing from the top; targets outside
+    the densities of the column, or only crossed next to NaN levels, are
+    NaN.
+
+    Parameters
+    ----------
+    field : array_like
+        the field to remap, on the levels of the column
+    s : array_like
+        practical salinity [psu (PSS-78)] of the levels
+    t : array_like
+        potential temperature [degree C (IPTS-68)] of the levels
+    coefficients : array_like
+        float64 `level_coefficients` of the reference pressure of the
+        potential density
+    targets : array_like
+        float64 increasing potential density anomalies ``rho - 1000``
+        [kg/m^3]
+
+    Returns
+    -------
+    remapped : array
+        field on the target surfaces
+    """
+    p, a0, a1, a2, a3, b0, b1, b2, c0 = (
+        coefficients[0],
+        coefficients[1],
+        coefficients[2],
+        coefficients[3],
+        coefficients[4],
+        coefficients[5],
+        coefficients[6],
+        coefficients[7],
+        coefficients[8],
+    )
+    found = np.zeros(out.shape[0], dtype=np.bool_)
+    out[:] = np.nan
+    s_dn, t_dn = np.float64(s[0]), np.float64(t[0])
+    bulk_mod = _bulkmod_level(s_dn, t_dn, a0, a1, a2, a3, b0, b1, b2, c0)
+    sigma_up = _rho_s(s_dn, t_dn) / (1.0 - p / bulk_mod) - 1000.0
+    for k in range(field.shape[0] - 1):
+        s_dn, t_dn = np.float64(s[k + 1]), np.float64(t[k + 1])
+        bulk_mod = _bulkmod_level(s_dn, t_dn, a0, a1, a2, a3, b0, b1, b2, c0)
+        sigma_dn = _rho_s(s_dn, t_dn) / (1.0 - p / bulk_mod) - 1000.0
+        field_up, field_dn = np.float64(field[k]), np.float64(field[k + 1])
+        if not (
+            np.isnan(sigma_up)
+            or np.isnan(sigma_dn)
+            or np.isnan(field_up)
+            or np.isnan(field_dn)
+        ):
+            # the targets between the densities of the levels
+            lo, hi = min(sigma_up, sigma_dn), max(sigma_up, sigma_dn)
+            first = np.searchsorted(targets, lo, side="left")
+            last = np.searchsorted(targets, hi, side="right")
+            for i in range(first, last):
+                if not found[i]:
+                    weight = 0.0
+                    if sigma_dn != sigma_up:
+                        weight = (np.float64(targets[i]) - sigma_up) / (
+                            sigma_dn - sigma_up
+                        )
+                    out[i] = field_up + weight * (field_dn - field_up)
+                    found[i] = True
+        sigma_up = sigma_dn
+
+
+@_jit
+def _bin(edges, x):
+    """ Bin of x between edges, the last bin including its right edge; -1
+    outside of them or for NaN, and 0 for empty edges
+    """
+    if edges.shape[0] == 0:
+        return 0
+    if not (edges[0] <= x <= edges[-1]):
+        return -1
+    return min(np.searchsorted(edges, x, side="right") - 1, edges.shape[0] - 2)
+
+
+@_reduction
+def census(s, t, p, weights, t_edges, s_edges, rho_edges, hist):
+    """
+    Adds the weights of points to the bins of their potential temperature,
+    salinity and in-situ density in `hist`, without storing their density.
+
+    s, t, p and weights are arrays of the same shape, such as views from
+    `numpy.broadcast_to`, which read shared values through zero strides
+    rather than copies. Empty edges leave out their variable, with a single
+    bin for it in `hist`, and the density is only evaluated if `rho_edges`
+    is not empty. Points outside the bins, or with NaN inputs or weights,
+    are left out.
+    """
+    for index in np.ndindex(s.shape):
+        w = np.float64(weights[index])
+        if np.isnan(w):
+            continue
+        si = np.float64(s[index])
+        ti = np.float64(t[index])
+        t_bin = _bin(t_edges, ti)
+        s_bin = _bin(s_edges, si)
+        if t_bin < 0 or s_bin < 0:
+            continue
+        rho_bin = 0
+        if rho_edges.shape[0]:
+            rho_bin = _bin(rho_edges, _rho(si, ti, np.float64(p[index])))
+            if rho_bin < 0:
+                continue
+        hist[t_bin, s_bin, rho_bin] += w
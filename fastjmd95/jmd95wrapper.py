@@ -1,5 +1,11 @@
+import functools
 
-import fastjmd95.jmd95numba as jmd95numba
+import numpy as np
+
+from . import aot, instrument
+from ._dispatch import dtype_of
+from .options import (OPTIONS, ENGINE, PARALLEL_THRESHOLD, NUM_THREADS, FASTMATH,
+                      INSTRUMENT)
 
 try:
     import dask.array as dsa
@@ -23,25 +29,899 @@ def _any_xarray(*args):
     else:
         return False
 
-def maybe_wrap_arrays(func):
-    def wrapper(*args):
-        if _any_dask_array(*args):
-            rho = dsa.map_blocks(func,*args)
-        elif _any_xarray(*args):
-            rho = xr.apply_ufunc(func,*args,output_dtypes=[float],dask='parallelized')
+def _output_dtype(*args, dtype=None):
+    # the dtype of the kernel loop the arguments select: float32 kernels for
+    # float32 inputs, float64 otherwise; only dtypes are looked at, so lazy
+    # arrays are never converted to numpy
+    if dtype is not None:
+        return np.dtype(dtype)
+    if np.result_type(*[dtype_of(a) for a in args]) == np.float32:
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
+
+def _map_blocks_multi(func, dtypes, *args):
+    # one task per block computes every output, written straight into its
+    # slice of one array along a new leading axis; the outputs are split from
+    # it lazily afterwards, each back to its dtype
+    def stacked(*blocks):
+        shape = np.broadcast_shapes(*[np.shape(b) for b in blocks])
+        result = np.empty((len(dtypes),) + shape, dtype=np.result_type(*dtypes))
+        func(*blocks, out=tuple(result))
+        return result
+    chunks = dsa.core.broadcast_chunks(*[a.chunks for a in args
+                                         if isinstance(a, dsa.core.Array)])
+    out = dsa.map_blocks(stacked, *args, new_axis=0, chunks=((len(dtypes),),) + chunks,
+                         dtype=np.result_type(*dtypes))
+    return tuple(out[n].astype(dtype) for n, dtype in enumerate(dtypes))
+
+def _align_blocks(*args):
+    # chunk every array argument alike, converting numpy arrays: map_blocks
+    # would pass those, and dask arrays of a single block, whole to each block
+    args = [dsa.asarray(a) if np.ndim(a) else a for a in args]
+    arrays = [n for n, a in enumerate(args) if np.ndim(a)]
+    ndim = max(args[n].ndim for n in arrays)
+    pairs = []
+    for n in arrays:
+        pairs += [args[n], tuple(range(ndim - args[n].ndim, ndim))]
+    _, aligned = dsa.core.unify_chunks(*pairs)
+    for n, a in zip(arrays, aligned):
+        args[n] = a
+    return args
+
+def _masked(kernel, args, where, out=None, fill_value=None, **kwargs):
+    # numba's ufuncs do not support where=, so compute the selected points
+    # only and scatter them into out; like numpy, other points of a newly
+    # allocated out are left uninitialized, unless a fill_value is given
+    shape = np.broadcast_shapes(np.shape(where), *[np.shape(a) for a in args])
+    where = np.broadcast_to(np.asarray(where, dtype=bool), shape)
+    result = kernel(*[np.broadcast_to(a, shape)[where] for a in args], **kwargs)
+    results = result if isinstance(result, tuple) else (result,)
+    if out is None:
+        out = (None,) * len(results)
+    elif not isinstance(out, tuple):
+        out = (out,)
+    out = tuple(np.empty(shape, dtype=r.dtype) if o is None else o
+                for o, r in zip(out, results))
+    for o, r in zip(out, results):
+        o[where] = r
+        if fill_value is not None:
+            # flags are False at masked points
+            o[~where] = fill_value if o.dtype.kind in 'fc' else 0
+    return out if isinstance(result, tuple) else out[0]
+
+def _mask_last_argument(func, fill_value):
+    # for blocks: evaluate func at the wet points of the mask, which is
+    # passed last so that dask and xarray line it up with the other inputs
+    def masked(*args, **kwargs):
+        return _masked(func, args[:-1], args[-1], fill_value=fill_value, **kwargs)
+    return masked
+
+def _with_num_threads(kernel, num_threads):
+    # numba's thread count is per calling thread: set it for this call only,
+    # so that later calls get numba's own setting back
+    def threaded(*args, **kwargs):
+        import numba
+        old = numba.get_num_threads()
+        numba.set_num_threads(num_threads)
+        try:
+            return kernel(*args, **kwargs)
+        finally:
+            numba.set_num_threads(old)
+    return threaded
+
+def _apply(name, *args, engine='serial', fastmath=False, parallel_threshold=None,
+           num_threads=None, where=None, elements=None, **kwargs):
+    # call kernel `name` on numpy arguments; numba is only imported when the
+    # JIT kernels are needed, so that the ahead-of-time compiled ones, when
+    # they are built, start without it. `elements` is the number of points for
+    # the parallel threshold, if the arguments do not broadcast to them
+    if parallel_threshold is None:
+        parallel_threshold = OPTIONS[PARALLEL_THRESHOLD]
+    if elements is None and engine == 'parallel':
+        elements = np.broadcast(*args).size
+    if engine == 'parallel' and elements >= parallel_threshold:
+        import fastjmd95.jmd95numba as jmd95numba
+        kernel = jmd95numba.parallel_kernel(name, fastmath)
+        if num_threads:
+            kernel = _with_num_threads(kernel, num_threads)
+    elif fastmath:
+        import fastjmd95.jmd95numba as jmd95numba
+        kernel = jmd95numba.fastmath_kernel(name)
+    elif name in aot.kernels and set(kwargs) <= {'dtype', 'out'}:
+        kernel = aot.kernels[name]
+    else:
+        import fastjmd95.jmd95numba as jmd95numba
+        kernel = getattr(jmd95numba, name)
+    if where is not None:
+        return _masked(kernel, args, where, **kwargs)
+    return kernel(*args, **kwargs)
+
+def _prepare(func, name, args, dtype, engine=None, fastmath=None, size=None):
+    # the engine options for the kernels, resolved here so that dask workers
+    # get the caller's; the dispatch path of args; and func, reported under
+    # name if the instrument option is set
+    kwargs = {'engine': engine or OPTIONS[ENGINE],
+              'fastmath': OPTIONS[FASTMATH] if fastmath is None else fastmath,
+              'parallel_threshold': OPTIONS[PARALLEL_THRESHOLD],
+              'num_threads': OPTIONS[NUM_THREADS]}
+    if kwargs['engine'] not in ('serial', 'parallel'):
+        raise ValueError("engine must be 'serial' or 'parallel', got %r" % (engine,))
+    if _any_dask_array(*args):
+        path = 'dask'
+    elif _any_xarray(*args):
+        path = 'xarray'
+    else:
+        path = 'numpy'
+    if OPTIONS[INSTRUMENT] is not None:
+        func = instrument.timed(func, OPTIONS[INSTRUMENT], name, path, dtype, size=size)
+    return func, path, kwargs
+
+def maybe_wrap_arrays(func=None, nout=1, name=None, dtypes=None):
+    """
+    Make a function of numpy arrays (with `nout` outputs) accept dask arrays
+    and xarray DataArrays, plus these keyword arguments:
+
+    engine : {'serial', 'parallel'}, optional
+        Engine for numpy inputs; default: the ``engine`` option.
+    dtype : dtype, optional
+        Dtype of the result; by default float32 for float32 inputs and
+        float64 otherwise. Float32 inputs are read as they are, also for
+        float64 results; the kernels always evaluate in float64.
+    out : array or tuple of arrays, optional
+        Preallocated output(s) for numpy inputs, written in place and
+        returned instead of allocating new arrays.
+    where : array_like of bool, optional
+        For numpy inputs, compute only where True; elsewhere `out` keeps its
+        values (or is left uninitialized if `out` is not given).
+    casting : str, optional
+        Numpy casting rule for the inputs and `out`.
+    fastmath : bool, optional
+        Use the kernels compiled with fast-math flags; default: the
+        ``fastmath`` option.
+    mask : array_like of bool, optional
+        True at wet points: only these are computed, and results elsewhere
+        are `fill_value`. Unlike `where`, also supported for dask and xarray
+        inputs, chunked like them.
+    fill_value : scalar, optional
+        Value of the results where `mask` is False; default: NaN. Flags are
+        False there.
+
+    `out` and `where` raise ``TypeError`` for dask and xarray inputs, whose
+    results are always new lazy arrays; `engine`, `dtype`, `casting`,
+    `fastmath` and `mask` are applied to every block. So are the options in
+    effect when the function is called, rather than when the blocks are
+    computed, also on the workers of the processes and distributed
+    schedulers.
+
+    With the ``instrument`` option set, each evaluation of `func` is
+    reported under `name` (default: the name of `func`). `dtypes` gives the
+    dtype of outputs that do not follow the inputs, such as flags, and None
+    for those that do.
+    """
+    if func is None:
+        return lambda f: maybe_wrap_arrays(f, nout=nout, name=name, dtypes=dtypes)
+    name = name or func.__name__
+    @functools.wraps(func)
+    def wrapper(*args, engine=None, dtype=None, out=None, where=None, casting=None,
+                fastmath=None, mask=None, fill_value=np.nan):
+        out_dtype = _output_dtype(*args, dtype=dtype)
+        out_dtypes = [out_dtype if d is None else np.dtype(d)
+                      for d in (dtypes or [None] * nout)]
+        kernel, path, kwargs = _prepare(func, name, args, out_dtype, engine, fastmath)
+        for key, value in [('dtype', dtype), ('casting', casting)]:
+            if value is not None:
+                kwargs[key] = value
+        if path != 'numpy' and (out is not None or where is not None):
+            raise TypeError("out= and where= are only supported for numpy arrays")
+        if where is not None and mask is not None:
+            raise TypeError("where= and mask= cannot be combined")
+        if mask is not None and path != 'numpy':
+            if path == 'xarray' and not isinstance(mask, xr.DataArray):
+                # numpy masks go with the trailing dimensions of the inputs
+                template = [a for a in args if isinstance(a, xr.DataArray)][0]
+                mask = xr.DataArray(mask, dims=template.dims[template.ndim - np.ndim(mask):])
+            kernel = _mask_last_argument(kernel, fill_value)
+            args = args + (mask,)
+        if path == 'dask':
+            args = _align_blocks(*args)
+            # map_blocks keeps its own dtype argument, so bind the kernel's
+            block_func = functools.partial(kernel, **kwargs)
+            if nout == 1:
+                rho = dsa.map_blocks(block_func,*args,dtype=out_dtype)
+            else:
+                rho = _map_blocks_multi(block_func, out_dtypes, *args)
+        elif path == 'xarray':
+            rho = xr.apply_ufunc(kernel,*args,output_core_dims=[[]] * nout,
+                                 output_dtypes=out_dtypes,dask='parallelized',
+                                 kwargs=kwargs)
         else:
-            rho = func(*args)
+            for key, value in [('out', out), ('where', where)]:
+                if value is not None:
+                    kwargs[key] = value
+            if mask is not None:
+                rho = _masked(kernel, args, mask, fill_value=fill_value, **kwargs)
+            else:
+                rho = kernel(*args,**kwargs)
         return rho
     return wrapper
 
+def warmup(functions=None, dtypes=None, engine=None, fastmath=None):
+    """
+    Compile kernels now rather than on their first call.
+
+    Parameters
+    ----------
+    functions : list of str or functions, optional
+        The functions to compile, e.g. ``['rho', fastjmd95.drhodt]``;
+        default: all of them.
+    dtypes : list of dtypes, optional
+        Input dtypes to compile for, e.g. ``[np.float32]``; default: all
+        supported dtypes.
+    engine : {'serial', 'parallel'}, optional
+        Engine to compile the kernels for; default: the current engine
+        option. Serial kernels that are compiled ahead of time are skipped.
+    fastmath : bool, optional
+        Compile the fast-math kernels; default: the ``fastmath`` option.
+    """
+    import fastjmd95.jmd95numba as jmd95numba
+    engine = engine or OPTIONS[ENGINE]
+    fastmath = OPTIONS[FASTMATH] if fastmath is None else fastmath
+    if functions is None:
+        functions = [name for name in jmd95numba._kernels if not name.startswith('_')]
+    functions = [getattr(f, '__name__', f) for f in functions]
+    if engine == 'parallel':
+        jmd95numba.warmup(functions, dtypes, target='parallel', fastmath=fastmath)
+    elif fastmath:
+        jmd95numba.warmup(functions, dtypes, fastmath=True)
+    else:
+        jmd95numba.warmup([f for f in functions if f not in aot.kernels], dtypes)
+
+@maybe_wrap_arrays
+def rho(s,t,p,**kwargs):
+    return _apply('rho',s,t,p,**kwargs)
+
+@maybe_wrap_arrays
+def drhodt(s,t,p,**kwargs):
+    return _apply('drhodt',s,t,p,**kwargs)
+
+@maybe_wrap_arrays
+def drhods(s,t,p,**kwargs):
+    return _apply('drhods',s,t,p,**kwargs)
+
+@maybe_wrap_arrays(nout=3)
+def rho_and_derivatives(s,t,p,**kwargs):
+    return _apply('rho_and_derivatives',s,t,p,**kwargs)
+
+@maybe_wrap_arrays
+def alpha(s,t,p,**kwargs):
+    return _apply('alpha',s,t,p,**kwargs)
+
 @maybe_wrap_arrays
-def rho(s,t,p):
-    return jmd95numba.rho(s,t,p)
-    
+def beta(s,t,p,**kwargs):
+    return _apply('beta',s,t,p,**kwargs)
+
+@maybe_wrap_arrays(nout=2)
+def alpha_beta(s,t,p,**kwargs):
+    return _apply('alpha_beta',s,t,p,**kwargs)
+
+@maybe_wrap_arrays(nout=2, dtypes=[None, bool])
+def theta_from_rho(rho,s,p,**kwargs):
+    return _apply('theta_from_rho',rho,s,p,**kwargs)
+
+@maybe_wrap_arrays(nout=2, dtypes=[None, bool])
+def s_from_rho(rho,t,p,**kwargs):
+    return _apply('s_from_rho',rho,t,p,**kwargs)
+
+@maybe_wrap_arrays(name='rho_levels')
+def _rho_levels(s,t,*coefficients,**kwargs):
+    return _apply('rho_levels',s,t,*coefficients,**kwargs)
+
+def rho_levels(s, t, p, axis=0, **kwargs):
+    """
+    Computes in-situ density for fields whose pressure only depends on the
+    vertical level, like MITgcm output.
+
+    The pressure dependent terms of the bulk modulus are evaluated once per
+    level, so each point only evaluates polynomials in s and t. The result
+    equals ``rho(s, t, p)`` with p broadcast along `axis`.
+
+    Parameters
+    ----------
+    s : array_like
+        practical salinity [psu (PSS-78)]
+    t : array_like
+        potential temperature [degree C (IPTS-68)];
+        same shape as s
+    p : array_like
+        1D pressure of each level [dbar]
+    axis : int or str
+        Vertical axis of s and t, or for xarray inputs the name of the
+        vertical dimension; ignored if p is a DataArray, whose dimension is
+        used instead.
+    **kwargs
+        ``engine``, ``dtype``, ``out``, ``where``, ``casting``,
+        ``fastmath``, ``mask`` and ``fill_value``, as for `rho`.
+
+    Returns
+    -------
+    dens : array
+        density [kg/m^3]
+
+    Example
+    -------
+    >>> rho_levels(salt, theta, [5., 15., 25.], axis=1)
+    """
+    import fastjmd95.jmd95numba as jmd95numba
+    # in float64 for every loop, so that float32 fields are not evaluated
+    # with rounded coefficients
+    coefficients = jmd95numba.level_coefficients(np.asarray(p))
+    if _any_xarray(s, t):
+        template = s if isinstance(s, xr.DataArray) else t
+        if isinstance(p, xr.DataArray):
+            dims = p.dims
+        else:
+            dims = [axis if isinstance(axis, str) else template.dims[axis]]
+        coefficients = [xr.DataArray(c, dims=dims) for c in coefficients]
+    else:
+        ndim = max(np.ndim(s), np.ndim(t))
+        axis = axis % ndim
+        shape = [-1 if i == axis else 1 for i in range(ndim)]
+        coefficients = [c.reshape(shape) for c in coefficients]
+        if _any_dask_array(s, t):
+            # match the vertical chunks, so blocks line up with their levels
+            template = s if isinstance(s, dsa.core.Array) else t
+            chunks = [template.chunks[axis] if i == axis else (1,) for i in range(ndim)]
+            coefficients = [dsa.from_array(c, chunks=chunks) for c in coefficients]
+    return _rho_levels(s, t, *coefficients, **kwargs)
+
+@maybe_wrap_arrays(name='rho_z')
+def _rho_z(s,t,z,lat,**kwargs):
+    return _apply('rho_z',s,t,z,lat,**kwargs)
+
+@maybe_wrap_arrays(name='drhodt_z')
+def _drhodt_z(s,t,z,lat,**kwargs):
+    return _apply('drhodt_z',s,t,z,lat,**kwargs)
+
+@maybe_wrap_arrays(name='drhods_z')
+def _drhods_z(s,t,z,lat,**kwargs):
+    return _apply('drhods_z',s,t,z,lat,**kwargs)
+
+def rho_z(s, t, z, lat=None, **kwargs):
+    """
+    Computes in-situ density at depth rather than pressure, converting depth
+    to pressure inside the kernel, without a full-size pressure array.
+
+    Parameters
+    ----------
+    s : array_like
+        practical salinity [psu (PSS-78)]
+    t : array_like
+        potential temperature [degree C (IPTS-68)];
+        same shape as s
+    z : array_like
+        depth [m]; broadcastable to shape of s. Its sign is ignored, so
+        heights (negative below the surface, like MITgcm's ``Z``) work too.
+    lat : array_like, optional
+        latitude [degrees north]; broadcastable to shape of s. If given,
+        pressure follows Saunders (1981); otherwise it is hydrostatic,
+        ``RHO_CONST * GRAVITY * |z|`` with the constants of `jmd95numba`
+        (1029 kg/m^3 and 9.81 m/s^2).
+    **kwargs
+        As for `rho`.
+
+    Returns
+    -------
+    dens : array
+        density [kg/m^3]
+
+    Example
+    -------
+    >>> rho_z(salt, theta, ds.Z, lat=ds.YC)
+    """
+    return _rho_z(s, t, z, np.nan if lat is None else lat, **kwargs)
+
+def drhodt_z(s, t, z, lat=None, **kwargs):
+    """
+    Computes the derivative of density with respect to potential
+    temperature at depth rather than pressure; see `rho_z`.
+    """
+    return _drhodt_z(s, t, z, np.nan if lat is None else lat, **kwargs)
+
+def drhods_z(s, t, z, lat=None, **kwargs):
+    """
+    Computes the derivative of density with respect to salinity at depth
+    rather than pressure; see `rho_z`.
+    """
+    return _drhods_z(s, t, z, np.nan if lat is None else lat, **kwargs)
+
+@maybe_wrap_arrays
+def sigma0(s,t,**kwargs):
+    return _apply('sigma0',s,t,**kwargs)
+
+@maybe_wrap_arrays
+def sigma1(s,t,**kwargs):
+    return _apply('sigma1',s,t,**kwargs)
+
 @maybe_wrap_arrays
-def drhodt(s,t,p):
-    return jmd95numba.drhodt(s,t,p)
+def sigma2(s,t,**kwargs):
+    return _apply('sigma2',s,t,**kwargs)
 
 @maybe_wrap_arrays
-def drhods(s,t,p):
-    return jmd95numba.drhods(s,t,p)
+def sigma3(s,t,**kwargs):
+    return _apply('sigma3',s,t,**kwargs)
+
+@maybe_wrap_arrays
+def sigma4(s,t,**kwargs):
+    return _apply('sigma4',s,t,**kwargs)
+
+@maybe_wrap_arrays(name='sigma')
+def _sigma(s,t,pref,**kwargs):
+    return _apply('sigma',s,t,pref,**kwargs)
+
+# the reference pressures [dbar] of sigma0 to sigma4
+_SIGMA_PRESSURES = {1000. * n: f for n, f in enumerate([sigma0, sigma1, sigma2,
+                                                        sigma3, sigma4])}
+
+def sigma(s, t, pref, **kwargs):
+    """
+    Computes potential density anomaly ``rho - 1000`` referenced to `pref`.
+
+    The anomaly is taken in float64, before rounding to the dtype of the
+    result, so float32 results keep more significant digits than
+    ``rho(s, t, pref) - 1000``. For the reference pressures 0, 1000, 2000,
+    3000 and 4000 dbar the kernels of `sigma0` to `sigma4` are used, whose
+    reference pressure terms are constants evaluated when they compile.
+
+    Parameters
+    ----------
+    s : array_like
+        practical salinity [psu (PSS-78)]
+    t : array_like
+        potential temperature [degree C (IPTS-68)];
+        same shape as s
+    pref : array_like
+        reference pressure [dbar]; broadcastable to shape of s
+    **kwargs
+        As for `rho`.
+
+    Returns
+    -------
+    sigma : array
+        potential density anomaly [kg/m^3]
+
+    Example
+    -------
+    >>> sigma(35.5, 3., 2000.)
+    37.41911
+    """
+    if np.ndim(pref) == 0 and not _any_dask_array(pref) and not _any_xarray(pref) \
+            and float(pref) in _SIGMA_PRESSURES:
+        return _SIGMA_PRESSURES[float(pref)](s, t, **kwargs)
+    return _sigma(s, t, pref, **kwargs)
+
+def n2(s, t, p, dz, axis=0, engine=None, dtype=None, fastmath=None):
+    """
+    Computes the squared buoyancy frequency N^2 at the interfaces between
+    vertical levels, walking each column once.
+
+    At each interface, the densities of the levels above and below are
+    referenced to its pressure, the mean of theirs, so that
+    ``N^2 = GRAVITY / rho * (rho_below - rho_above) / dz``, with rho the
+    mean of the two. The surface density of each level is evaluated once
+    for its two interfaces.
+
+    Parameters
+    ----------
+    s : array_like
+        practical salinity [psu (PSS-78)]
+    t : array_like
+        potential temperature [degree C (IPTS-68)];
+        same shape as s
+    p : array_like
+        pressure [dbar]; broadcastable to shape of s, or 1D pressure of each
+        level
+    dz : array_like
+        distance [m] between consecutive levels, positive; broadcastable to
+        the shape of the result, or 1D distance between each pair of levels
+    axis : int or str
+        Vertical axis of s and t, along which levels are ordered from the
+        surface down; for xarray inputs, the name of the vertical dimension.
+        Dask arrays may be chunked along it.
+    engine, dtype, fastmath : optional
+        As for `rho`.
+
+    Returns
+    -------
+    n2 : array
+        squared buoyancy frequency [1/s^2], of the shape of s with one
+        element less along `axis`. For xarray inputs, a DataArray whose
+        vertical dimension is that of `dz`, if it is a DataArray, or else
+        keeps its name but not its coordinates.
+
+    Example
+    -------
+    >>> n2(ds.SALT, ds.THETA, -ds.Z, ds.drC[1:-1], axis='Z')
+    """
+    if _any_xarray(s, t, p):
+        return _n2_xarray(s, t, p, dz, axis, engine=engine, dtype=dtype,
+                          fastmath=fastmath)
+    ndim = max(np.ndim(s), np.ndim(t))
+    axis = axis % ndim
+    nz = np.shape(s if np.ndim(s) == ndim else t)[axis]
+    if nz < 2:
+        raise ValueError("n2 needs at least two levels along axis %d" % axis)
+    # 1D p and dz are per level and per interface
+    column = [-1 if i == axis else 1 for i in range(ndim)]
+    if np.ndim(p) == 1 and ndim > 1:
+        p = np.reshape(p, column)
+    if np.ndim(dz) == 0:
+        dz = np.full(nz - 1, dz)
+    if np.ndim(dz) == 1 and ndim > 1:
+        dz = np.reshape(dz, column)
+    out_dtype = _output_dtype(s, t, p, dz, dtype=dtype)
+
+    def columns(s, t, p, dz):
+        return _apply('n2', s, t, p, dz, elements=np.broadcast(s, t, p).size,
+                      axes=[(axis,)] * 5, dtype=out_dtype, **kwargs)
+
+    block_func, path, kwargs = _prepare(
+        columns, 'n2', (s, t, p, dz), out_dtype, engine, fastmath,
+        size=lambda s, t, p, dz: np.broadcast(s, t, p).size)
+    if path == 'numpy':
+        return block_func(s, t, p, dz)
+    s, t, p = _align_blocks(s, t, p)
+    levels = [a.chunks[axis] for a in (s, t, p) if np.ndim(a) and a.shape[axis] > 1][0]
+    if levels[-1] == 1:
+        # a last block of one level would have no interfaces of its own
+        levels = levels[:-2] + (levels[-2] + 1,)
+        s, t, p = [a.rechunk({axis: levels}) if np.ndim(a) and a.shape[axis] > 1 else a
+                   for a in (s, t, p)]
+    # each block of levels but the last also takes the first level of the
+    # next, for the interface between them
+    s, t, p = [dsa.overlap.overlap(a, depth={axis: (0, 1)}, boundary='none')
+               if np.ndim(a) and a.shape[axis] > 1 else a for a in (s, t, p)]
+    interfaces = levels[:-1] + (levels[-1] - 1,)
+    template = [a for a in (s, t, p) if np.ndim(a) == ndim][0]
+    dz = dsa.asarray(dz)
+    dz = dz.rechunk([interfaces if i == axis else
+                     (template.chunks[i] if dz.shape[i] > 1 else (1,))
+                     for i in range(ndim)])
+    chunks = dsa.core.broadcast_chunks(*[a.chunks for a in (s, t, p) if np.ndim(a)])
+    chunks = tuple(interfaces if i == axis else c for i, c in enumerate(chunks))
+    return dsa.map_blocks(block_func, s, t, p, dz, chunks=chunks, dtype=out_dtype)
+
+def _n2_xarray(s, t, p, dz, axis, **kwargs):
+    # n2 of DataArrays broadcast together, with dz along the interfaces
+    template = [a for a in (s, t, p) if isinstance(a, xr.DataArray)][0]
+    dim = axis if isinstance(axis, str) else template.dims[axis]
+    s, t, p = [a if isinstance(a, xr.DataArray) else
+               xr.DataArray(a, dims=template.dims[template.ndim - np.ndim(a):])
+               for a in (s, t, p)]
+    s, t, p = [a.transpose(*s.dims) for a in xr.broadcast(s, t, p)]
+    coords = {name: c for name, c in s.coords.items() if dim not in c.dims}
+    interface_dim = dim
+    if isinstance(dz, xr.DataArray):
+        # e.g. MITgcm's Zl, otherwise dz is along dim, one shorter
+        interface_dim = ([d for d in dz.dims if d not in s.dims] or [dim])[0]
+        dims = [interface_dim if d == dim else d for d in s.dims]
+        coords.update({name: c for name, c in dz.coords.items()
+                       if interface_dim != dim and interface_dim in c.dims})
+        dz = dz.expand_dims([d for d in dims if d not in dz.dims]).transpose(*dims).data
+    result = n2(s.data, t.data, p.data, dz, axis=s.dims.index(dim), **kwargs)
+    return xr.DataArray(result, dims=[interface_dim if d == dim else d for d in s.dims],
+                        coords=coords)
+
+def remap_to_density(field, s, t, pref, targets, axis=0, engine=None, dtype=None,
+                     fastmath=None):
+    """
+    Remaps a field onto surfaces of potential density in one pass over each
+    column, evaluating density on the fly rather than as a full field.
+
+    Each target is interpolated linearly between the levels at its first
+    crossing from the top; targets outside the densities of a column are
+    NaN, as are points of the field next to NaN (e.g. land) levels.
+
+    Parameters
+    ----------
+    field : array_like
+        the field to remap, e.g. a velocity or a tracer
+    s : array_like
+        practical salinity [psu (PSS-78)]; same shape as field
+    t : array_like
+        potential temperature [degree C (IPTS-68)]; same shape as field
+    pref : float
+        reference pressure [dbar] of the potential density, e.g. 2000. for
+        sigma2
+    targets : array_like
+        1D increasing potential density anomalies ``rho - 1000`` [kg/m^3]
+    axis : int or str
+        Vertical axis of field, s and t; for xarray inputs, the name of the
+        vertical dimension. Dask arrays may be chunked along the other axes;
+        chunks along this one are merged.
+    engine, dtype, fastmath : optional
+        As for `rho`.
+
+    Returns
+    -------
+    remapped : array
+        the field with `axis` replaced by the targets; for xarray inputs, a
+        dimension ``sigma`` holding them
+
+    Example
+    -------
+    >>> remap_to_density(ds.UVEL, ds.SALT, ds.THETA, 2000., np.arange(30, 38, 0.1),
+    ...                  axis='Z')
+    """
+    targets = np.asarray(targets)
+    if targets.ndim != 1 or np.any(np.diff(targets) <= 0):
+        raise ValueError("targets must be 1D and increasing")
+    if _any_xarray(field, s, t):
+        template = [a for a in (field, s, t) if isinstance(a, xr.DataArray)][0]
+        dim = axis if isinstance(axis, str) else template.dims[axis]
+        # the vertical dimension goes last, and is replaced in place
+        remapped = xr.apply_ufunc(
+            remap_to_density, field, s, t,
+            kwargs={'pref': pref, 'targets': targets, 'axis': -1, 'engine': engine,
+                    'dtype': dtype, 'fastmath': fastmath},
+            input_core_dims=[[dim]] * 3, output_core_dims=[['sigma']],
+            exclude_dims={dim}, dask='allowed')
+        remapped = remapped.transpose(*[('sigma' if d == dim else d)
+                                        for d in template.dims])
+        attrs = {'long_name': 'potential density anomaly referenced to %g dbar' % pref,
+                 'units': 'kg m-3'}
+        return remapped.assign_coords(sigma=('sigma', targets, attrs))
+    import fastjmd95.jmd95numba as jmd95numba
+    ndim = max(np.ndim(a) for a in (field, s, t))
+    axis = axis % ndim
+    out_dtype = _output_dtype(field, s, t, dtype=dtype)
+    # the reference pressure terms of the bulk modulus and the targets stay
+    # float64 for every loop; they do not select the loop of the fields
+    coefficients = jmd95numba.level_coefficients(pref)
+    targets = targets.astype(np.float64)
+
+    def columns(field, s, t):
+        return _apply('remap_to_density', field, s, t, coefficients, targets,
+                      elements=np.broadcast(field, s, t).size,
+                      axes=[(axis,), (axis,), (axis,), (0,), (0,), (axis,)],
+                      dtype=out_dtype, **kwargs)
+
+    block_func, path, kwargs = _prepare(columns, 'remap_to_density', (field, s, t),
+                                        out_dtype, engine, fastmath)
+    if path == 'numpy':
+        return block_func(field, s, t)
+    # whole columns in each block
+    field, s, t = [dsa.asarray(a).rechunk({axis - ndim + np.ndim(a): -1})
+                   for a in (field, s, t)]
+    field, s, t = _align_blocks(field, s, t)
+    chunks = dsa.core.broadcast_chunks(field.chunks, s.chunks, t.chunks)
+    chunks = tuple((targets.size,) if i == axis else c for i, c in enumerate(chunks))
+    return dsa.map_blocks(block_func, field, s, t, chunks=chunks, dtype=out_dtype)
+
+def census(s, t, p, weights=None, bins=None, t_bins=None, s_bins=None):
+    """
+    Computes a census of water masses: the sum of `weights` (e.g. cell
+    volumes) in bins of density, and optionally of potential temperature and
+    salinity.
+
+    Density is computed and binned point by point, never stored: memory
+    scales with the number of bins, not with the size of the fields. Each
+    dask block gives a partial histogram, which dask sums in a tree
+    reduction.
+
+    Parameters
+    ----------
+    s : array_like
+        practical salinity [psu (PSS-78)]
+    t : array_like
+        potential temperature [degree C (IPTS-68)];
+        broadcastable to shape of s
+    p : array_like
+        pressure [dbar], or a reference pressure for potential density;
+        broadcastable to shape of s
+    weights : array_like, optional
+        weight of each point, broadcastable to shape of s; default: 1, to
+        count points
+    bins : array_like, optional
+        increasing edges of the density bins [kg/m^3]
+    t_bins, s_bins : array_like, optional
+        increasing edges of the potential temperature [degree C] and
+        salinity [psu] bins
+
+    The last bin of each variable includes its right edge, like
+    `numpy.histogram`; points outside the bins, or with NaN inputs or
+    weights, are left out.
+
+    Returns
+    -------
+    census : array
+        sums of weights, with an axis for each of `t_bins`, `s_bins` and
+        `bins` given, in that order. Lazy for dask inputs; for xarray
+        inputs, a DataArray with dimensions ``t_bin``, ``s_bin`` and
+        ``rho_bin`` whose coordinates are the centres of the bins.
+
+    Example
+    -------
+    >>> census(ds.SALT, ds.THETA, 2000., weights=ds.rA * ds.drF * ds.hFacC,
+    ...        bins=np.arange(1030., 1040., 0.05))
+    """
+    import fastjmd95.jmd95numba as jmd95numba
+    edges = {name: np.empty(0) if e is None else np.asarray(e, dtype=np.float64)
+             for name, e in [('t_bin', t_bins), ('s_bin', s_bins), ('rho_bin', bins)]}
+    if all(e.size == 0 for e in edges.values()):
+        raise ValueError("census needs at least one of bins, t_bins and s_bins")
+    for name, e in edges.items():
+        if e.size and (e.ndim != 1 or e.size < 2 or np.any(np.diff(e) <= 0)):
+            raise ValueError("%ss must be 1D increasing edges" % name)
+    shape = tuple(max(e.size - 1, 1) for e in edges.values())
+    dims = [name for name, e in edges.items() if e.size]
+    weights = 1. if weights is None else weights
+
+    def partial(s, t, p, weights):
+        # the histogram of a block; broadcast arguments stay views
+        args = [np.asarray(a) for a in (s, t, p, weights)]
+        size = np.broadcast_shapes(*[a.shape for a in args])
+        args = [np.broadcast_to(a, size) for a in args]
+        hist = np.zeros(shape)
+        jmd95numba.census(*args, *edges.values(), hist)
+        return hist.reshape([hist.shape[i] for i, e in enumerate(edges.values()) if e.size])
+
+    partial, path, _ = _prepare(partial, 'census', (s, t, p, weights),
+                                np.dtype(np.float64))
+    if path == 'xarray':
+        arrays = xr.broadcast(*[a for a in (s, t, p, weights) if isinstance(a, xr.DataArray)])
+        template = arrays[0]
+        args = [a.broadcast_like(template).transpose(*template.dims).data
+                if isinstance(a, xr.DataArray) else a for a in (s, t, p, weights)]
+        coords = {name: 0.5 * (edges[name][1:] + edges[name][:-1]) for name in dims}
+        return xr.DataArray(census(*args, bins=bins, t_bins=t_bins, s_bins=s_bins),
+                            dims=dims, coords=coords)
+    if path == 'numpy':
+        return partial(s, t, p, weights)
+    args = _align_blocks(s, t, p, weights)
+    ndim = max(np.ndim(a) for a in args)
+    numblocks = dsa.core.broadcast_chunks(*[a.chunks for a in args if np.ndim(a)])
+    hist_shape = [shape[i] for i, e in enumerate(edges.values()) if e.size]
+
+    def block(*blocks):
+        return partial(*blocks).reshape((1,) * ndim + tuple(hist_shape))
+
+    # one partial histogram per block, then summed over the blocks
+    partials = dsa.map_blocks(block, *args, dtype=np.float64,
+                              new_axis=list(range(ndim, ndim + len(hist_shape))),
+                              chunks=tuple((1,) * len(c) for c in numblocks)
+                              + tuple((h,) for h in hist_shape))
+    return partials.sum(axis=tuple(range(ndim)))
+
+# fields that one multi-output kernel computes together, the largest first
+_FUSED_FIELDS = {
+    'rho_and_derivatives': ('rho', 'drhodt', 'drhods'),
+    'alpha_beta': ('alpha', 'beta'),
+    '_rho_and_drhodt': ('rho', 'drhodt'),
+    '_rho_and_drhods': ('rho', 'drhods'),
+    '_drhodt_and_drhods': ('drhodt', 'drhods'),
+}
+
+# every field of eos_fields, and how to compute it on its own
+_FIELDS = {name: functools.partial(_apply, name)
+           for name in ['rho', 'drhodt', 'drhods', 'alpha', 'beta']}
+
+def _potential_density(name, s, t, *args, **kwargs):
+    return _apply(name, s, t, **kwargs)
+
+_FIELDS.update({name: functools.partial(_potential_density, name)
+                for name in ['sigma0', 'sigma1', 'sigma2', 'sigma3', 'sigma4']})
+
+# the same at depth, from the kernels taking depth and latitude
+_FUSED_FIELDS_Z = {kernel + '_z': fused for kernel, fused in _FUSED_FIELDS.items()}
+_FIELDS_Z = {name: functools.partial(_apply, name + '_z')
+             for name in ['rho', 'drhodt', 'drhods', 'alpha', 'beta']}
+_FIELDS_Z.update({name: func for name, func in _FIELDS.items() if name.startswith('sigma')})
+
+def _fields(*args,fields=('rho',),depth=False,out=None,**kwargs):
+    # args are s, t and p, or s, t, z and lat at depth; out holds one array
+    # per field, written by whichever kernel computes it
+    if out is not None and not isinstance(out, tuple):
+        out = (out,)
+    if out is not None and len(out) != len(fields):
+        raise ValueError("out must have one array per field, got %d for %d fields"
+                         % (len(out), len(fields)))
+    fused_fields, single_fields = ((_FUSED_FIELDS_Z, _FIELDS_Z) if depth
+                                   else (_FUSED_FIELDS, _FIELDS))
+    outs = dict(zip(fields, out or ()))
+    results = {}
+    # the fused kernels that compute requested fields only, so that none of
+    # their outputs is allocated in vain
+    for kernel, fused in fused_fields.items():
+        if all(f in fields and f not in results for f in fused):
+            fused_out = {'out': tuple(outs[f] for f in fused)} if outs else {}
+            results.update(zip(fused, _apply(kernel,*args,**fused_out,**kwargs)))
+    for f in fields:
+        if f not in results:
+            results[f] = single_fields[f](*args,**({'out': outs[f]} if outs else {}),
+                                          **kwargs)
+    results = tuple(results[f] for f in fields)
+    return results if len(results) > 1 else results[0]
+
+def _fields_function(fields, depth=False):
+    # _fields for these fields, accepting dask and xarray inputs
+    fields = tuple(fields)
+    unknown = [f for f in fields if f not in _FIELDS]
+    if unknown or not fields:
+        raise ValueError("fields must be a non-empty sequence of %s, got %r"
+                         % (sorted(_FIELDS), fields))
+    return maybe_wrap_arrays(functools.partial(_fields, fields=fields, depth=depth),
+                             nout=len(fields), name='eos_fields_z' if depth else 'eos_fields')
+
+def eos_fields(s, t, p, fields=('rho',), **kwargs):
+    """
+    Computes several equation of state fields in one pass over the inputs.
+
+    For dask arrays, each block of the inputs is read by a single task that
+    computes every requested field; the fields are split from its result
+    lazily. Fields that share a fused kernel (e.g. ``rho`` and ``drhodt``, or
+    ``alpha`` and ``beta``) are computed together.
+
+    Parameters
+    ----------
+    s : array_like
+        practical salinity [psu (PSS-78)]
+    t : array_like
+        potential temperature [degree C (IPTS-68)];
+        same shape as s
+    p : array_like
+        pressure [dbar]; broadcastable to shape of s
+    fields : sequence of str
+        Fields to compute, any of ``'rho'``, ``'drhodt'``, ``'drhods'``,
+        ``'alpha'``, ``'beta'`` and ``'sigma0'`` to ``'sigma4'`` (potential
+        density anomalies referenced to 0 to 4000 dbar).
+    **kwargs
+        ``engine``, ``dtype``, ``out``, ``where``, ``casting``,
+        ``fastmath``, ``mask`` and ``fill_value``, as for `rho`; `out` is a
+        tuple of one array per field.
+
+    Returns
+    -------
+    tuple of arrays, one per field, in the order of `fields`
+    """
+    fields = tuple(fields)
+    result = _fields_function(fields)(s, t, p, **kwargs)
+    return result if len(fields) > 1 else (result,)
+
+def eos_fields_z(s, t, z, lat=None, fields=('rho',), **kwargs):
+    """
+    Computes several equation of state fields in one pass over the inputs,
+    like `eos_fields`, at depth rather than pressure.
+
+    Depth is converted to pressure inside the kernels, as in `rho_z`, and
+    fields that share a fused kernel are computed together.
+
+    Parameters
+    ----------
+    s : array_like
+        practical salinity [psu (PSS-78)]
+    t : array_like
+        potential temperature [degree C (IPTS-68)];
+        same shape as s
+    z : array_like
+        depth [m]; broadcastable to shape of s. Its sign is ignored, so
+        heights (negative below the surface, like MITgcm's ``Z``) work too.
+    lat : array_like, optional
+        latitude [degrees north], as for `rho_z`.
+    fields : sequence of str
+        Fields to compute, as for `eos_fields`.
+    **kwargs
+        As for `eos_fields`.
+
+    Returns
+    -------
+    tuple of arrays, one per field, in the order of `fields`
+
+    Example
+    -------
+    >>> rho, alpha, beta = eos_fields_z(salt, theta, ds.Z, lat=ds.YC,
+    ...                                 fields=['rho', 'alpha', 'beta'])
+    """
+    fields = tuple(fields)
+    func = _fields_function(fields, depth=True)
+    result = func(s, t, z, np.nan if lat is None else lat, **kwargs)
+    return result if len(fields) > 1 else (result,)
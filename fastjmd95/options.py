@@ -0,0 +1,93 @@
+ENGINE = "engine"
+PARALLEL_THRESHOLD = "parallel_threshold"
+NUM_THREADS = "num_threads"
+FASTMATH = "fastmath"
+INSTRUMENT = "instrument"
+
+OPTIONS = {
+    ENGINE: "serial",
+    PARALLEL_THRESHOLD: 100000,
+    NUM_THREADS: None,
+    FASTMATH: False,
+    INSTRUMENT: None,
+}
+
+_ENGINES = frozenset(["serial", "parallel"])
+
+
+def _positive_integer(value):
+    return isinstance(value, int) and value > 0
+
+
+def _valid_num_threads(value):
+    import numba
+
+    return value is None or (
+        _positive_integer(value) and value <= numba.config.NUMBA_NUM_THREADS
+    )
+
+
+_VALIDATORS = {
+    ENGINE: _ENGINES.__contains__,
+    PARALLEL_THRESHOLD: lambda value: isinstance(value, int) and value >= 0,
+    NUM_THREADS: _valid_num_threads,
+    FASTMATH: lambda value: isinstance(value, bool),
+    INSTRUMENT: lambda value: value is None or callable(value),
+}
+
+
+class set_options:
+    """
+    Set options for fastjmd95 globally or in a controlled context.
+
+    Parameters
+    ----------
+    engine : {'serial', 'parallel'}
+        Default engine for numpy inputs. ``'parallel'`` runs the kernels
+        compiled with numba's multithreaded ``target='parallel'``.
+        Default: ``'serial'``.
+    parallel_threshold : int
+        Inputs with fewer elements than this always use the serial kernels,
+        where threading overhead outweighs the work. Default: ``100000``.
+    num_threads : int, optional
+        Number of threads used by the parallel engine, at most
+        ``numba.config.NUMBA_NUM_THREADS``. Default: numba's own setting.
+    fastmath : bool
+        Use kernels compiled with LLVM fast-math flags, which reassociate the
+        polynomials and contract them into fused multiply-adds. Results
+        differ from the default kernels in the last few bits (see the README
+        for the measured error); NaNs still propagate. Default: ``False``.
+    instrument : callable, optional
+        Called with a `fastjmd95.instrument.Call` record (function, dispatch
+        path, dtype, elements and wall time) for every kernel evaluation,
+        e.g. a `fastjmd95.instrument.Recorder`. Default: ``None``, no
+        instrumentation.
+
+    Examples
+    --------
+    >>> fastjmd95.set_options(engine='parallel', num_threads=16)
+
+    or, to change the options temporarily,
+
+    >>> with fastjmd95.set_options(engine='parallel'):
+    ...     rho(s, t, p)
+    """
+
+    def __init__(self, **kwargs):
+        self.old = {}
+        for k, v in kwargs.items():
+            if k not in OPTIONS:
+                raise ValueError(
+                    "argument name %r is not in the set of valid options %r"
+                    % (k, set(OPTIONS))
+                )
+            if not _VALIDATORS[k](v):
+                raise ValueError("%r is not a valid value for %s" % (v, k))
+            self.old[k] = OPTIONS[k]
+        OPTIONS.update(kwargs)
+
+    def __enter__(self):
+        return
+
+    def __exit__(self, type, value, traceback):
+        OPTIONS.update(self.old)
@@ -1,10 +1,23 @@
+import os
+import subprocess
+import sys
 import numpy as np
 from itertools import product
 import pytest
 
-from fastjmd95 import rho, drhodt, drhods
+from fastjmd95 import (rho, drhodt, drhods, rho_and_derivatives,
+                       alpha, beta, alpha_beta, eos_fields, rho_levels,
+                       rho_z, drhodt_z, drhods_z, sigma, sigma0, sigma1,
+                       sigma2, sigma3, sigma4, n2,
+                       theta_from_rho, s_from_rho, remap_to_density, census,
+                       set_options, warmup, WetPoints)
+from fastjmd95 import jmd95numba
+from fastjmd95.options import OPTIONS
 from .reference_values import rho_expected, drhodt_expected, drhods_expected
 
+alpha_expected = -drhodt_expected / rho_expected
+beta_expected = drhods_expected / rho_expected
+
 import dask
 import dask.array
 import xarray as xr
@@ -64,7 +77,9 @@ all_arrays = ['dask_arrays', 'xarrays']
 @pytest.mark.parametrize('function,expected',
                          [(rho, rho_expected),
                          (drhodt, drhodt_expected),
-                         (drhods, drhods_expected)])
+                         (drhods, drhods_expected),
+                         (alpha, alpha_expected),
+                         (beta, beta_expected)])
 def test_functions(request, client, array_type, s_t_p, function, expected):
     s, t, p = s_t_p
     if array_type == 'dask_arrays':
@@ -78,3 +93,1080 @@ def test_functions(request, client, array_type, s_t_p, function, expected):
     client = request.getfixturevalue(client)
     actual = function(s, t, p)
     np.testing.assert_allclose(actual, expected, rtol=1e-2)
+
+
+@pytest.mark.parametrize('client', all_clients)
+@pytest.mark.parametrize('array_type', all_arrays)
+def test_rho_and_derivatives(request, client, array_type, s_t_p):
+    s, t, p = s_t_p
+    if array_type == 'dask_arrays':
+        if client != 'no_client':
+            s, t, p = _chunk(s, t, p)
+    elif array_type == 'xarrays':
+        if client != 'no_client':
+            s, t, p = _make_xarray(s, t, p, withdask=True)
+        else:
+            s, t, p = _make_xarray(s, t, p, withdask=False)
+    client = request.getfixturevalue(client)
+    actual = rho_and_derivatives(s, t, p)
+    assert len(actual) == 3
+    for a, expected in zip(actual, [rho_expected, drhodt_expected, drhods_expected]):
+        np.testing.assert_allclose(a, expected, rtol=1e-2)
+
+
+def test_rho_and_derivatives_matches_separate_kernels(s_t_p):
+    s, t, p = s_t_p
+    for dtype, rtol in [(np.float32, 1e-6), (np.float64, 1e-14)]:
+        args = [a.astype(dtype) for a in (s, t, p)]
+        fused = rho_and_derivatives(*args)
+        for actual, function in zip(fused, [rho, drhodt, drhods]):
+            expected = function(*args)
+            assert actual.dtype == dtype
+            np.testing.assert_allclose(actual, expected, rtol=rtol)
+
+
+@pytest.mark.parametrize('array_type', all_arrays)
+def test_alpha_beta(threaded_client, array_type, s_t_p):
+    s, t, p = s_t_p
+    if array_type == 'dask_arrays':
+        s, t, p = _chunk(s, t, p)
+    else:
+        s, t, p = _make_xarray(s, t, p, withdask=True)
+    actual_alpha, actual_beta = alpha_beta(s, t, p)
+    np.testing.assert_allclose(actual_alpha, alpha_expected, rtol=1e-2)
+    np.testing.assert_allclose(actual_beta, beta_expected, rtol=1e-2)
+
+
+@pytest.mark.parametrize('function,expected',
+                         [(rho, rho_expected),
+                          (drhodt, drhodt_expected),
+                          (drhods, drhods_expected)])
+def test_parallel_engine(s_t_p, function, expected):
+    s, t, p = s_t_p
+    serial = function(s, t, p)
+    with set_options(parallel_threshold=0):
+        np.testing.assert_array_equal(function(s, t, p, engine='parallel'), serial)
+        with set_options(engine='parallel'):
+            np.testing.assert_array_equal(function(s, t, p), serial)
+    np.testing.assert_allclose(serial, expected, rtol=1e-2)
+
+
+def test_parallel_engine_multiple_outputs(s_t_p):
+    s, t, p = s_t_p
+    with set_options(engine='parallel', parallel_threshold=0):
+        actual = rho_and_derivatives(s, t, p)
+    for a, expected in zip(actual, [rho_expected, drhodt_expected, drhods_expected]):
+        np.testing.assert_allclose(a, expected, rtol=1e-2)
+
+
+def test_parallel_engine_small_arrays_use_serial_kernel(s_t_p):
+    s, t, p = s_t_p
+    jmd95numba.parallel_kernel.cache_clear()
+    with set_options(engine='parallel', parallel_threshold=s.size + 1):
+        rho(s, t, p)
+    assert jmd95numba.parallel_kernel.cache_info().currsize == 0
+    with set_options(engine='parallel', parallel_threshold=s.size):
+        rho(s, t, p)
+    assert jmd95numba.parallel_kernel.cache_info().currsize == 1
+
+
+def test_set_options():
+    default = OPTIONS['engine']
+    with set_options(engine='parallel', num_threads=1):
+        assert OPTIONS['engine'] == 'parallel'
+        assert OPTIONS['num_threads'] == 1
+    assert OPTIONS['engine'] == default
+    with pytest.raises(ValueError):
+        set_options(engine='gpu')
+    with pytest.raises(ValueError):
+        set_options(num_threads=0)
+    with pytest.raises(ValueError):
+        set_options(not_an_option=True)
+    with pytest.raises(ValueError):
+        rho(35.5, 3., 3000., engine='gpu')
+
+
+def test_num_threads_restored():
+    # with more threads than this machine may have, so that 1 differs from
+    # numba's own setting
+    code = ("import fastjmd95, numba, numpy as np\n"
+            "assert numba.get_num_threads() == 4\n"
+            "with fastjmd95.set_options(num_threads=1, parallel_threshold=0):\n"
+            "    fastjmd95.rho(np.full(10, 35.5), 3., 3000., engine='parallel')\n"
+            "assert numba.get_num_threads() == 4")
+    subprocess.check_call([sys.executable, '-c', code],
+                          env=dict(os.environ, NUMBA_NUM_THREADS='4'))
+
+
+@pytest.mark.parametrize('dtype,rtol', [('f8', 1e-14), ('f4', 1e-6)])
+@pytest.mark.parametrize('function,expected',
+                         [(rho, rho_expected),
+                          (drhodt, drhodt_expected),
+                          (drhods, drhods_expected)])
+def test_fastmath(s_t_p, function, expected, dtype, rtol):
+    s, t, p = [a.astype(dtype) for a in s_t_p]
+    default = function(s, t, p)
+    fast = function(s, t, p, fastmath=True)
+    assert fast.dtype == default.dtype
+    np.testing.assert_allclose(fast, default, rtol=rtol)
+    # no less accurate against the reference values than the default kernels
+    error = lambda a: np.abs((a.astype('f8') - expected) / expected).max()
+    assert error(fast) <= error(default) + rtol
+    with set_options(fastmath=True):
+        np.testing.assert_array_equal(function(s, t, p), fast)
+        with set_options(engine='parallel', parallel_threshold=0):
+            np.testing.assert_array_equal(function(s, t, p), fast)
+        np.testing.assert_array_equal(function(*_chunk(s, t, p)).compute(), fast)
+
+
+def test_fastmath_propagates_nan():
+    assert np.isnan(rho(np.nan, 3., 3000., fastmath=True))
+    assert np.isnan(rho_and_derivatives(35.5, np.nan, 3000., fastmath=True)).all()
+    with pytest.raises(ValueError):
+        set_options(fastmath='yes')
+
+
+def test_cache_dir(tmp_path):
+    env = dict(os.environ, FASTJMD95_CACHE_DIR=str(tmp_path))
+    code = 'import fastjmd95; fastjmd95.rho(35.5, 3., 3000.)'
+    subprocess.check_call([sys.executable, '-c', code], env=env)
+    cached = [f for _, _, files in os.walk(tmp_path) for f in files]
+    assert any(f.startswith('jmd95numba.rho-') and f.endswith('.nbi') for f in cached)
+
+
+def test_cache_dir_threads(tmp_path):
+    # kernels compiled on first use by several threads at once
+    env = dict(os.environ, FASTJMD95_CACHE_DIR=str(tmp_path))
+    code = ("import fastjmd95; from concurrent.futures import ThreadPoolExecutor; "
+            "functions = [fastjmd95.rho, fastjmd95.drhodt, fastjmd95.drhods, fastjmd95.alpha]; "
+            "list(ThreadPoolExecutor(4).map(lambda f: f(35.5, 3., 3000.), functions))")
+    subprocess.check_call([sys.executable, '-c', code], env=env)
+    cached = [f for _, _, files in os.walk(tmp_path) for f in files]
+    for name in ['rho', 'drhodt', 'drhods', 'alpha']:
+        assert any(f.startswith('jmd95numba.%s-' % name) and f.endswith('.nbi')
+                   for f in cached)
+
+
+def test_aot_kernels(tmp_path, s_t_p):
+    import importlib.util
+    from fastjmd95 import aot
+    aot.build(str(tmp_path))
+    filename = [f for f in os.listdir(tmp_path) if f.startswith(aot.MODULE_NAME + '.')
+                and not f.endswith('.json')][0]
+    spec = importlib.util.spec_from_file_location(aot.MODULE_NAME, tmp_path / filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    kernels = aot._load(module)
+    assert set(['rho', 'drhodt', 'drhods', 'rho_and_derivatives']) <= set(kernels)
+
+    s, t, p = s_t_p
+    for name, expected in [('rho', rho_expected),
+                           ('drhodt', drhodt_expected),
+                           ('drhods', drhods_expected)]:
+        actual = kernels[name](s, t, p)
+        np.testing.assert_array_equal(actual, getattr(jmd95numba, name)(s, t, p))
+        np.testing.assert_allclose(actual, expected, rtol=1e-2)
+        args32 = [a.astype('f4') for a in (s, t, p)]
+        actual32 = kernels[name](*args32)
+        assert actual32.dtype == np.float32
+        np.testing.assert_array_equal(actual32, getattr(jmd95numba, name)(*args32))
+        np.testing.assert_array_equal(kernels[name](*args32, dtype='f8'),
+                                      getattr(jmd95numba, name)(*args32, dtype='f8'))
+    for actual, expected in zip(kernels['rho_and_derivatives'](s, t, p),
+                                jmd95numba.rho_and_derivatives(s, t, p)):
+        np.testing.assert_array_equal(actual, expected)
+    # float64 coefficients do not select the loop of float32 fields
+    coefficients = jmd95numba.level_coefficients(p)
+    for dtype in [None, 'f8']:
+        args32 = [a.astype('f4') for a in (s, t)] + list(coefficients)
+        actual = kernels['rho_levels'](*args32, dtype=dtype)
+        assert actual.dtype == (dtype or np.float32)
+        np.testing.assert_array_equal(actual, jmd95numba.rho_levels(*args32, dtype=dtype))
+    out = np.empty_like(s)
+    assert kernels['rho'](s, t, p, out=out) is out
+    np.testing.assert_array_equal(out, jmd95numba.rho(s, t, p))
+    out32 = np.empty(s.shape, dtype='f4')
+    kernels['rho'](s, t, p, out=out32)
+    np.testing.assert_array_equal(out32, jmd95numba.rho(s, t, p).astype('f4'))
+    # scalars and broadcasting behave like the ufuncs
+    assert kernels['rho'](35.5, 3., 3000.) == jmd95numba.rho(35.5, 3., 3000.)
+    np.testing.assert_array_equal(kernels['rho']([35.5], [3.], [3000.]),
+                                  jmd95numba.rho([35.5], [3.], [3000.]))
+    np.testing.assert_array_equal(kernels['rho'](s.reshape(-1, 6), 3., p.reshape(-1, 6)),
+                                  jmd95numba.rho(s.reshape(-1, 6), 3., p.reshape(-1, 6)))
+
+
+def test_lazy_compilation():
+    code = ("import fastjmd95, numpy as np; "
+            "from fastjmd95.jmd95numba import _compile_loop; "
+            "assert _compile_loop.cache_info().currsize == 0; "
+            "fastjmd95.rho(35.5, 3., 3000.); "
+            "assert _compile_loop.cache_info().currsize == 1")
+    subprocess.check_call([sys.executable, '-c', code])
+
+
+def test_lazy_kernel_list_inputs():
+    np.testing.assert_array_equal(jmd95numba.rho([35.5], [3.], [3000.]),
+                                  jmd95numba.rho(np.array([35.5]), 3., 3000.))
+    # Python scalars do not promote float32 arrays
+    assert jmd95numba.rho(np.float32([35.5]), 3., 3000.).dtype == np.float32
+
+
+def test_warmup():
+    jmd95numba._compile_loop.cache_clear()
+    # float32 -> float32 and float32 -> float64 loops
+    warmup(functions=['rho', drhodt], dtypes=[np.float32])
+    compiled = jmd95numba._compile_loop.cache_info().currsize
+    assert compiled == 4
+    warmup(functions=[alpha_beta])
+    assert jmd95numba._compile_loop.cache_info().currsize == compiled + 3
+
+
+@pytest.mark.parametrize('function', [rho, alpha, rho_and_derivatives])
+def test_list_inputs(function):
+    expected = function(np.array([35.5]), np.array([3.]), np.array([3000.]))
+    actual = function([35.5], [3.], [3000.])
+    for a, e in zip(*[r if isinstance(r, tuple) else (r,) for r in (actual, expected)]):
+        np.testing.assert_array_equal(a, e)
+    assert np.asarray(function(np.float32([35.5]), 3., 3000.)[0]).dtype == np.float32
+
+
+@pytest.mark.parametrize('array_type', ['numpy'] + all_arrays + ['xarrays_dask'])
+@pytest.mark.parametrize('function', [rho, alpha, rho_and_derivatives])
+def test_float32_preserved(threaded_client, array_type, s_t_p, function):
+    s, t, p = [a.astype('f4') for a in s_t_p]
+    if array_type == 'dask_arrays':
+        s, t, p = _chunk(s, t, p)
+    elif array_type == 'xarrays':
+        s, t, p = _make_xarray(s, t, p)
+    elif array_type == 'xarrays_dask':
+        s, t, p = _make_xarray(s, t, p, withdask=True)
+    result = function(s, t, p)
+    for r in (result if isinstance(result, tuple) else [result]):
+        # the declared dtype of lazy results agrees with the computed one
+        assert r.dtype == np.float32
+        assert np.asarray(r).dtype == np.float32
+
+    result = function(s, t, p, dtype=np.float64)
+    for r in (result if isinstance(result, tuple) else [result]):
+        assert r.dtype == np.float64
+        assert np.asarray(r).dtype == np.float64
+
+
+@pytest.mark.parametrize('function', [rho, drhodt, drhods, rho_and_derivatives])
+def test_dtype_override_values(s_t_p, function):
+    s, t, p = [a.astype('f4') for a in s_t_p]
+    # float32 inputs are computed in float64, whatever the output dtype
+    expected = function(*[a.astype('f8') for a in (s, t, p)])
+    mixed = function(s, t, p, dtype='f8')
+    single = function(s, t, p)
+    if function is not rho_and_derivatives:
+        expected, mixed, single = [expected], [mixed], [single]
+    for e, m, r in zip(expected, mixed, single):
+        np.testing.assert_array_equal(m, e)
+        np.testing.assert_array_equal(r, e.astype('f4'))
+
+
+def test_mixed_precision_does_not_upcast_inputs():
+    import tracemalloc
+    n = 1000000
+    s = np.full(n, 35.5, dtype='f4')
+    t = np.full(n, 3., dtype='f4')
+    p = np.full(n, 3000., dtype='f4')
+    rho(s, t, p, dtype='f8')
+    tracemalloc.start()
+    result = rho(s, t, p, dtype='f8')
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert result.dtype == np.float64
+    # the result only, no float64 copies of the inputs
+    assert peak < 1.5 * result.nbytes
+
+
+def test_out_does_not_allocate():
+    import tracemalloc
+    n = 1000000
+    s = np.full(n, 35.5)
+    t = np.full(n, 3.)
+    out = np.empty(n)
+    rho(s, t, 3000., out=out)
+    tracemalloc.start()
+    result = rho(s, t, 3000., out=out)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert result is out
+    assert peak < out.nbytes / 10
+    np.testing.assert_allclose(out, 1041.83267, rtol=1e-6)
+
+
+def test_out_multiple_outputs(s_t_p):
+    s, t, p = s_t_p
+    out = tuple(np.empty_like(s) for _ in range(3))
+    result = rho_and_derivatives(s, t, p, out=out)
+    assert all(r is o for r, o in zip(result, out))
+    for o, expected in zip(out, [rho_expected, drhodt_expected, drhods_expected]):
+        np.testing.assert_allclose(o, expected, rtol=1e-2)
+
+
+def test_where(s_t_p):
+    s, t, p = s_t_p
+    where = s > 35
+    out = np.full_like(s, -1.)
+    result = rho(s, t, p, out=out, where=where)
+    assert result is out
+    np.testing.assert_allclose(out[where], rho_expected[where], rtol=1e-2)
+    assert (out[~where] == -1).all()
+    alpha_out, beta_out = np.zeros_like(s), np.zeros_like(s)
+    alpha_beta(s, t, p, out=(alpha_out, beta_out), where=where)
+    np.testing.assert_allclose(beta_out[where], beta_expected[where], rtol=1e-2)
+    assert (beta_out[~where] == 0).all()
+
+
+def test_casting(s_t_p):
+    s, t, p = s_t_p
+    out = np.empty(s.shape, dtype='f4')
+    with pytest.raises(TypeError):
+        rho(s, t, p, out=out, casting='no')
+    rho(s, t, p, out=out, casting='same_kind')
+    np.testing.assert_allclose(out, rho_expected, rtol=1e-2)
+
+
+@pytest.mark.parametrize('array_type', all_arrays)
+def test_out_and_where_rejected_for_lazy_arrays(array_type, s_t_p):
+    s, t, p = s_t_p
+    if array_type == 'dask_arrays':
+        s, t, p = _chunk(s, t, p)
+    else:
+        s, t, p = _make_xarray(s, t, p)
+    with pytest.raises(TypeError):
+        rho(s, t, p, out=np.empty(s.shape))
+    with pytest.raises(TypeError):
+        rho(s, t, p, where=np.ones(s.shape, bool))
+
+
+@pytest.mark.parametrize('array_type', ['numpy'] + all_arrays + ['xarrays_dask'])
+@pytest.mark.parametrize('function', [rho, drhodt, rho_and_derivatives])
+def test_mask(threaded_client, array_type, s_t_p, function):
+    s, t, p = s_t_p
+    # dry points hold zeros
+    mask = (np.arange(s.size) % 3) > 0
+    s = np.where(mask, s, 0.)
+    expected = function(s, t, p)
+    if array_type == 'dask_arrays':
+        s, t, p = _chunk(s, t, p)
+    elif array_type == 'xarrays':
+        s, t, p = _make_xarray(s, t, p)
+    elif array_type == 'xarrays_dask':
+        s, t, p = _make_xarray(s, t, p, withdask=True)
+    masks = [mask] if array_type == 'numpy' else [mask, _chunk(mask)[0],
+                                                   _make_xarray(mask)[0]]
+    for m, fill_value in product(masks, [np.nan, -1.]):
+        actual = function(s, t, p, mask=m, fill_value=fill_value)
+        for a, e in zip(np.atleast_2d(actual), np.atleast_2d(expected)):
+            np.testing.assert_array_equal(a[mask], e[mask])
+            np.testing.assert_array_equal(a[~mask], fill_value)
+
+
+def test_mask_computes_wet_points_only(s_t_p):
+    from fastjmd95.instrument import Recorder
+    s, t, p = s_t_p
+    mask = s > 35
+    recorder = Recorder()
+    with set_options(instrument=recorder):
+        sigma0, = eos_fields(s, t, p, fields=['sigma0'], mask=mask, fill_value=0.)
+    totals, = recorder.totals.values()
+    assert totals.elements == mask.sum()
+    np.testing.assert_array_equal(sigma0[~mask], 0.)
+    np.testing.assert_array_equal(sigma0[mask], rho(s, t, 0.)[mask] - 1000)
+    out = np.zeros(s.shape)
+    assert rho(s, t, p, mask=mask, out=out) is out
+    np.testing.assert_array_equal(out[~mask], np.nan)
+    with pytest.raises(TypeError):
+        rho(s, t, p, mask=mask, where=mask)
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_wet_points(s_t_p, lazy):
+    s, t, p = [a.reshape(5, 19, 6) for a in s_t_p]
+    mask = (np.arange(s.size).reshape(s.shape) % 4) > 0
+    wet = WetPoints(mask)
+    assert wet.size == mask.sum()
+    packed = wet.pack(s)
+    assert packed.shape == (wet.size,)
+    np.testing.assert_array_equal(s.ravel()[wet.index], packed)
+    # per-level pressure, broadcast against the grid
+    p_levels = p[:, :1, :1]
+    rho_packed = wet.apply(rho, s, t, p_levels)
+    np.testing.assert_array_equal(rho_packed, rho(packed, wet.pack(t), wet.pack(p_levels)))
+    for actual, expected in zip(wet.unpack(wet.apply(rho_and_derivatives, packed, t, p),
+                                           lazy=lazy),
+                                rho_and_derivatives(s, t, p, mask=mask)):
+        np.testing.assert_array_equal(np.asarray(actual), expected)
+    np.testing.assert_array_equal(np.asarray(wet.unpack(packed, fill_value=0., lazy=lazy)),
+                                  np.where(mask, s, 0.))
+    with pytest.raises(ValueError):
+        wet.unpack(packed[1:])
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_wet_points_time(s_t_p, lazy):
+    s, t, p = [a.reshape(5, 19, 6) for a in s_t_p]
+    mask = (np.arange(s.size).reshape(s.shape) % 4) > 0
+    wet = WetPoints(mask)
+    # three time steps over a 3-D grid
+    s4 = s + np.arange(3.)[:, None, None, None]
+    packed = wet.pack(s4)
+    assert packed.shape == (3, wet.size)
+    np.testing.assert_array_equal(packed[1], wet.pack(s4[1]))
+    rho_packed = wet.apply(rho, packed, t, p)
+    np.testing.assert_array_equal(rho_packed, wet.apply(rho, s4, t, p))
+    actual = wet.unpack(rho_packed, lazy=lazy)
+    if lazy:
+        assert actual.chunks[0] == (1, 1, 1)
+    np.testing.assert_array_equal(np.asarray(actual), rho(s4, t, p, mask=mask))
+    # with a DataArray mask
+    ds = _make_dataset(*s_t_p)
+    wet = WetPoints(ds.SALT > 35)
+    salt = xr.concat([ds.SALT + n for n in range(3)], dim='time')
+    packed = wet.pack(salt.transpose('j', 'time', 'i', 'Z'))
+    actual = wet.unpack(packed, lazy=lazy, dims=['time'])
+    assert actual.dims == ('time',) + ds.SALT.dims
+    xr.testing.assert_equal(actual.compute(), salt.where(ds.SALT > 35).reset_coords(drop=True))
+
+
+def test_wet_points_lazy_tasks():
+    import cloudpickle
+    mask = np.random.default_rng(0).uniform(size=(4, 100, 100)) > 0.3
+    mask[2] = False
+    wet = WetPoints(mask)
+    packed = np.arange(wet.size, dtype='f8')
+    actual = wet.unpack(packed, lazy=True)
+    np.testing.assert_array_equal(actual.compute(), wet.unpack(packed))
+    # the scatter tasks refer to blocks of the packed values and of the mask,
+    # rather than carrying them whole
+    tasks = [layer for name, layer in actual.dask.layers.items()
+             if name.startswith('scatter')][0]
+    assert len(cloudpickle.dumps(dict(tasks))) < packed.nbytes / 10
+
+
+def test_wet_points_dataarray(s_t_p):
+    ds = _make_dataset(*s_t_p)
+    wet = WetPoints(ds.SALT > 35)
+    # fields are lined up by dimension name
+    rho_packed = rho(wet.pack(ds.SALT.transpose('i', 'j', 'Z')), wet.pack(ds.THETA),
+                     wet.pack(-ds.Z))
+    actual = wet.unpack(rho_packed, lazy=True)
+    assert actual.dims == ds.SALT.dims
+    assert actual.name is None
+    xr.testing.assert_identical(actual.Z, ds.Z)
+    expected = rho(ds.SALT, ds.THETA, -ds.Z).where(ds.SALT > 35)
+    xr.testing.assert_allclose(actual.compute(), expected.reset_coords(drop=True),
+                               rtol=0, atol=0)
+
+
+@pytest.mark.parametrize('array_type', ['numpy'] + all_arrays)
+@pytest.mark.parametrize('function,function_z',
+                         [(rho, rho_z), (drhodt, drhodt_z), (drhods, drhods_z)])
+def test_depth(threaded_client, array_type, s_t_p, function, function_z):
+    s, t, p = s_t_p
+    z = -p
+    lat = np.linspace(-80, 80, s.size)
+    hydrostatic = jmd95numba.RHO_CONST * jmd95numba.GRAVITY * 1e-4 * p
+    # Saunders (1981)
+    c1 = 5.92e-3 + 5.25e-3 * np.sin(np.deg2rad(lat)) ** 2
+    saunders = ((1 - c1) - np.sqrt((1 - c1) ** 2 - 8.84e-6 * p)) / 4.42e-6
+    if array_type == 'dask_arrays':
+        s, t, z = _chunk(s, t, z)
+    elif array_type == 'xarrays':
+        s, t, z = _make_xarray(s, t, z)
+    np.testing.assert_allclose(function_z(s, t, z), function(*s_t_p[:2], hydrostatic),
+                               rtol=1e-13)
+    np.testing.assert_allclose(function_z(s, t, z, lat), function(*s_t_p[:2], saunders),
+                               rtol=1e-13)
+
+
+def test_saunders_check_value():
+    # Saunders (1981): 7500 dbar at 30 degrees north is 7321.45 m deep
+    np.testing.assert_allclose(jmd95numba._pressure_at_depth(7321.45, 30.), 7500.,
+                               atol=0.01)
+    assert jmd95numba._pressure_at_depth(-7321.45, 30.) == \
+        jmd95numba._pressure_at_depth(7321.45, 30.)
+
+
+@pytest.mark.parametrize('n, func', list(enumerate([sigma0, sigma1, sigma2, sigma3, sigma4])))
+def test_sigma(n, func, s_t_p):
+    s, t, _ = s_t_p
+    pref = 1000. * n
+    expected = rho(s, t, pref) - 1000
+    np.testing.assert_allclose(func(s, t), expected, rtol=1e-13)
+    np.testing.assert_array_equal(sigma(s, t, pref), func(s, t))
+    np.testing.assert_allclose(sigma(s, t, np.full_like(s, pref)), expected,
+                               rtol=1e-13)
+    actual = func(s.astype('f4'), t.astype('f4'))
+    assert actual.dtype == np.float32
+    np.testing.assert_allclose(actual, expected, rtol=1e-6)
+    sigma_n, = eos_fields(s, t, s_t_p[2], fields=['sigma%d' % n])
+    np.testing.assert_array_equal(sigma_n, func(s, t))
+
+
+@pytest.fixture
+def column():
+    # a stratified ocean of 12 levels over a 4 x 5 grid
+    rng = np.random.default_rng(0)
+    p = np.linspace(5., 3000., 12)
+    t = np.linspace(25., 2., 12)[:, None, None] + rng.uniform(0, 0.5, (12, 4, 5))
+    s = 35. + rng.uniform(0, 0.3, (12, 4, 5))
+    dz = 0.99 * np.diff(p)
+    # both densities at the interface pressure
+    pm = 0.5 * (p[:-1] + p[1:])[:, None, None]
+    above, below = rho(s[:-1], t[:-1], pm), rho(s[1:], t[1:], pm)
+    expected = 9.81 * (below - above) / (0.5 * (above + below) * dz[:, None, None])
+    return s, t, p, dz, expected
+
+
+def test_n2(column):
+    s, t, p, dz, expected = column
+    np.testing.assert_allclose(n2(s, t, p, dz), expected, rtol=1e-12)
+    actual = n2(np.moveaxis(s, 0, -1), np.moveaxis(t, 0, -1), p, dz, axis=-1)
+    np.testing.assert_allclose(np.moveaxis(actual, -1, 0), expected, rtol=1e-12)
+    assert n2(s.astype('f4'), t.astype('f4'), p.astype('f4'),
+              dz.astype('f4')).dtype == np.float32
+
+
+@pytest.mark.parametrize('chunks', [(12, 2, 5), (5, 4, 5), (1, 2, 2), (11, 4, 5)])
+def test_n2_dask(column, chunks):
+    s, t, p, dz, expected = column
+    actual = n2(dask.array.from_array(s, chunks=chunks), t, p, dz)
+    assert actual.shape == expected.shape
+    assert all(c > 0 for c in actual.chunks[0])
+    np.testing.assert_allclose(actual.compute(), expected, rtol=1e-12)
+
+
+def test_n2_xarray(column):
+    s, t, p, dz, expected = column
+    z = -0.99 * p
+    s, t = [xr.DataArray(a, dims=['Z', 'Y', 'X'], coords={'Z': z}) for a in (s, t)]
+    dz = xr.DataArray(dz, dims=['Zl'], coords={'Zl': z[1:]})
+    actual = n2(s.chunk({'Z': 4}), t, xr.DataArray(p, dims=['Z']), dz, axis='Z')
+    assert actual.dims == ('Zl', 'Y', 'X')
+    np.testing.assert_array_equal(actual.Zl, z[1:])
+    np.testing.assert_allclose(actual, expected, rtol=1e-12)
+
+
+@pytest.mark.parametrize('array_type', ['numpy'] + all_arrays)
+def test_inverse_solvers(array_type, s_t_p):
+    s, t, p = s_t_p
+    dens = rho(s, t, p)
+    if array_type == 'dask_arrays':
+        dens, s, t, p = _chunk(dens, s, t, p)
+    elif array_type == 'xarrays':
+        dens, s, t, p = _make_xarray(dens, s, t, p)
+    for solve, args, expected in [(theta_from_rho, (dens, s, p), t),
+                                  (s_from_rho, (dens, t, p), s)]:
+        actual, converged = solve(*args)
+        assert converged.dtype == bool
+        assert np.asarray(converged).dtype == bool
+        assert np.all(converged)
+        np.testing.assert_allclose(actual, expected, atol=1e-9)
+
+
+def test_inverse_solvers_flags():
+    theta, converged = theta_from_rho(np.array([1041.83267, 900., np.nan]), 35.5, 3000.)
+    np.testing.assert_allclose(theta[0], 3., atol=1e-5)
+    np.testing.assert_array_equal(converged, [True, False, False])
+    assert np.isnan(theta[2])
+    # float32 in, float32 out; the flags stay bool
+    salt, converged = s_from_rho(np.float32(1041.83267), np.float32(3.), np.float32(3000.))
+    assert salt.dtype == np.float32 and converged.dtype == bool
+    salt, converged = s_from_rho(np.float32(1041.83267), np.float32(3.), np.float32(3000.),
+                                 dtype='f8')
+    assert salt.dtype == np.float64 and converged
+
+
+@pytest.mark.parametrize('array_type', ['numpy', 'dask_arrays', 'xarrays_dask'])
+def test_remap_to_density(column, array_type):
+    s, t, _, _, _ = column
+    # a land column below level 8
+    s[8:, 0, 0] = t[8:, 0, 0] = np.nan
+    field = np.random.default_rng(1).normal(size=s.shape)
+    targets = np.arange(30., 38., 0.25)
+    sigma_2 = sigma2(s, t)
+    expected = np.full((targets.size,) + s.shape[1:], np.nan)
+    for j, i in np.ndindex(*s.shape[1:]):
+        wet = ~np.isnan(sigma_2[:, j, i])
+        expected[:, j, i] = np.interp(targets, sigma_2[wet, j, i], field[wet, j, i],
+                                      left=np.nan, right=np.nan)
+    if array_type == 'dask_arrays':
+        field = dask.array.from_array(field, chunks=(5, 2, 3))
+    elif array_type == 'xarrays_dask':
+        field, s, t = [xr.DataArray(a, dims=['Z', 'Y', 'X']) for a in (field, s, t)]
+        field = field.chunk({'Y': 2})
+    actual = remap_to_density(field, s, t, 2000., targets, axis='Z' if
+                              array_type == 'xarrays_dask' else 0)
+    if array_type == 'xarrays_dask':
+        assert actual.dims == ('sigma', 'Y', 'X')
+        np.testing.assert_array_equal(actual.sigma, targets)
+    np.testing.assert_allclose(actual, expected, rtol=1e-12)
+    with pytest.raises(ValueError):
+        remap_to_density(field, s, t, 2000., targets[::-1])
+
+
+def test_remap_to_density_float32(column):
+    s, t, _, _, _ = column
+    field = np.random.default_rng(1).normal(size=s.shape)
+    # float64 targets do not promote float32 fields
+    targets = np.arange(30., 38., 0.25)
+    expected = remap_to_density(field, s, t, 2000., targets)
+    actual = remap_to_density(*[a.astype('f4') for a in (field, s, t)], 2000., targets)
+    assert actual.dtype == np.float32
+    np.testing.assert_allclose(actual, expected, rtol=1e-3, atol=1e-3)
+    actual = remap_to_density(*[a.astype('f4') for a in (field, s, t)], 2000., targets,
+                              dtype='f8')
+    assert actual.dtype == np.float64
+
+
+@pytest.mark.parametrize('array_type', ['numpy', 'dask_arrays', 'xarrays_dask'])
+def test_census(column, array_type):
+    s, t, p, _, _ = column
+    s, p = s.copy(), p[:, None, None]
+    s[8:, 0, 0] = np.nan
+    volume = np.random.default_rng(2).uniform(size=s.shape)
+    t_bins, s_bins = np.linspace(-2., 30., 9), np.linspace(30., 40., 6)
+    bins = np.linspace(1020., 1060., 21)
+    rho_ = rho(s, t, np.broadcast_to(p, s.shape))
+    wet = ~np.isnan(rho_)
+    expected, _ = np.histogramdd(np.stack([t[wet], s[wet], rho_[wet]], axis=-1),
+                                 bins=[t_bins, s_bins, bins], weights=volume[wet])
+    if array_type == 'dask_arrays':
+        s = dask.array.from_array(s, chunks=(5, 2, 3))
+    elif array_type == 'xarrays_dask':
+        s, t, volume = [xr.DataArray(a, dims=['Z', 'Y', 'X']) for a in (s, t, volume)]
+        s, p = s.chunk({'Z': 5}), xr.DataArray(p[:, 0, 0], dims=['Z'])
+    actual = census(s, t, p, volume, bins=bins, t_bins=t_bins, s_bins=s_bins)
+    if array_type == 'xarrays_dask':
+        assert actual.dims == ('t_bin', 's_bin', 'rho_bin')
+        np.testing.assert_allclose(actual.rho_bin, bins[:-1] + 1.)
+    np.testing.assert_allclose(actual, expected, rtol=1e-12)
+    # potential density, counting points
+    actual = census(s, t, 2000., bins=bins)
+    assert actual.shape == (bins.size - 1,)
+    np.testing.assert_array_equal(actual, np.histogram(sigma2(*column[:2])[wet] + 1000., bins)[0])
+    with pytest.raises(ValueError):
+        census(s, t, p)
+
+
+def test_cli_chunks():
+    from fastjmd95.cli import _chunks
+    assert _chunks((10, 20, 30), 1000) == (1, 20, 30)
+    assert _chunks((10, 20, 30), 10) == (1, 1, 10)
+    assert _chunks((10, 20, 30), 10 ** 6) == (10, 20, 30)
+
+
+def test_cli_memory(tmp_path):
+    import tracemalloc
+    from fastjmd95 import cli
+    pytest.importorskip('scipy')
+    shape = (10, 200, 200)
+    rng = np.random.default_rng(0)
+    dims = ['Z', 'j', 'i']
+    xr.Dataset({'SALT': (dims, rng.uniform(30, 40, shape)),
+                'THETA': (dims, rng.uniform(-2, 30, shape)),
+                'PRESS': (['Z'], np.linspace(0., 5000., shape[0]))}
+               ).to_netcdf(tmp_path / 'state.nc')
+    fields = ['rho', 'sigma0', 'alpha', 'beta']
+    # two levels of inputs and results per chunk
+    memory = 2 * (3 + len(fields)) * 8 * shape[1] * shape[2]
+
+    class Discard:
+        def __setitem__(self, key, value):
+            pass
+
+    def run():
+        ds = cli._open(str(tmp_path / 'state.nc'))
+        out = cli.compute(ds, fields=fields, pressure='PRESS', memory=memory)
+        assert out.rho.chunks[0] == (2,) * 5
+        with dask.config.set(scheduler='synchronous'):
+            dask.array.store([out[f].data for f in fields], [Discard() for f in fields])
+        ds.close()
+
+    run()
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert peak < 1.1 * memory
+
+
+def test_cli_depth(s_t_levels):
+    from fastjmd95 import cli, eos_fields_z
+    s, t, p = s_t_levels
+    dims = ['Z', 'j', 'i']
+    ds = xr.Dataset({'SALT': (dims, s), 'THETA': (dims, t), 'YC': (['j'], np.arange(19.))},
+                    coords={'Z': -p})
+    out = cli.compute(ds, fields=['rho', 'alpha'], depth='Z', lat='YC', memory='1MB')
+    expected = eos_fields_z(s, t, -p[:, None, None], np.arange(19.)[:, None],
+                            fields=['rho', 'alpha'])
+    np.testing.assert_array_equal(out.rho, expected[0])
+    np.testing.assert_array_equal(out.alpha, expected[1])
+
+
+@pytest.mark.parametrize('argv', [['--pressure', 'PRESS', '--fields', 'density'],
+                                  ['--pressure', 'PRESS', '--threads', '0'],
+                                  ['--pressure', 'PRESS', '--threads', '100000'],
+                                  ['--pressure', 'PRESS', '--depth', 'Z'],
+                                  ['--pressure', 'PRESS', '--lat', 'YC'],
+                                  ['--fields', 'rho']])
+def test_cli_invalid(argv):
+    from fastjmd95.cli import main
+    with pytest.raises(SystemExit):
+        main(['state.nc', 'eos.zarr'] + argv)
+
+
+@pytest.mark.parametrize('store', ['eos.nc', 'eos.zarr'])
+def test_cli(tmp_path, s_t_levels, store):
+    from fastjmd95.cli import main
+    pytest.importorskip('zarr' if store.endswith('.zarr') else 'scipy')
+    s, t, p = s_t_levels
+    dims = ['Z', 'j', 'i']
+    ds = xr.Dataset({'SALT': (dims, s), 'THETA': (dims, t), 'PRESS': (['Z'], p)})
+    ds.to_netcdf(tmp_path / 'state.nc') if store.endswith('.nc') else \
+        ds.to_zarr(tmp_path / 'state.zarr')
+    source = tmp_path / ('state' + os.path.splitext(store)[1])
+    # chunks of one level
+    main([str(source), str(tmp_path / store), '--pressure', 'PRESS',
+          '--fields', 'rho', 'sigma0', '--memory', str(5 * 8 * s[0].size), '--threads', '1'])
+    out = xr.open_dataset(tmp_path / store, engine='zarr' if store.endswith('.zarr') else None)
+    np.testing.assert_allclose(out.rho, rho(s, t, p[:, None, None]), rtol=1e-13)
+    np.testing.assert_allclose(out.sigma0, sigma0(s, t), rtol=1e-13)
+    assert out.rho.attrs['units'] == 'kg m-3'
+    out.close()
+
+
+def test_census_memory():
+    import tracemalloc
+    shape = (10, 100, 100)
+    s, t = np.full(shape, 35.5), np.full(shape, 3.)
+    p = np.linspace(0., 5000., shape[0])[:, None, None]
+    bins = np.linspace(1020., 1060., 41)
+    census(s, t, p, 2., bins=bins)
+    tracemalloc.start()
+    actual = census(s, t, p, 2., bins=bins)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert actual.sum() == 2 * s.size
+    # per-level pressure and shared weights are not broadcast into copies
+    assert peak < s.nbytes / 10
+
+
+def test_dask_and_numpy_arguments(s_t_p):
+    # numpy arguments are chunked like the dask ones, also when broadcast
+    s, t, p = [a.reshape(30, 19) for a in s_t_p]
+    t = t[:1]
+    expected = rho_and_derivatives(s, t, p)
+    s = dask.array.from_array(s, chunks=(10, 5))
+    np.testing.assert_array_equal(rho(s, t, p).compute(), expected[0])
+    for a, e in zip(rho_and_derivatives(s, t, p), expected):
+        np.testing.assert_array_equal(a.compute(), e)
+
+
+@pytest.mark.parametrize('client', all_clients)
+@pytest.mark.parametrize('array_type', ['numpy'] + all_arrays)
+def test_eos_fields(request, client, array_type, s_t_p):
+    s, t, p = s_t_p
+    if array_type == 'dask_arrays':
+        s, t, p = _chunk(s, t, p)
+    elif array_type == 'xarrays':
+        s, t, p = _make_xarray(s, t, p, withdask=client != 'no_client')
+    request.getfixturevalue(client)
+    fields = ['beta', 'rho', 'drhods', 'alpha']
+    actual = eos_fields(s, t, p, fields=fields)
+    assert len(actual) == len(fields)
+    expected = {'rho': rho_expected, 'drhods': drhods_expected,
+                'alpha': alpha_expected, 'beta': beta_expected}
+    for a, f in zip(actual, fields):
+        np.testing.assert_allclose(a, expected[f], rtol=1e-2)
+    single, = eos_fields(s, t, p, fields=['drhodt'])
+    np.testing.assert_allclose(single, drhodt_expected, rtol=1e-2)
+
+
+def test_eos_fields_one_task_per_chunk(s_t_p):
+    s, t, p = _chunk(*s_t_p)
+    outputs = eos_fields(s, t, p, fields=['rho', 'alpha', 'beta'])
+    graph = dict(outputs[0].__dask_graph__())
+    # every field is split from the same block-wise layer
+    layers = set.intersection(*[set(o.dask.layers) for o in outputs])
+    kernel_layers = [name for name in layers if name.startswith('stacked')]
+    assert len(kernel_layers) == 1
+    kernel_tasks = [k for k in graph if k[0] == kernel_layers[0]]
+    assert len(kernel_tasks) == s.numblocks[0]
+
+
+def test_eos_fields_chunk_memory():
+    import tracemalloc
+    fields = ['rho', 'sigma0', 'alpha', 'beta']
+    s, t, p = [dask.array.full(10 ** 5, v, chunks=-1) for v in (35.5, 3., 3000.)]
+    result = eos_fields(s, t, p, fields=fields)[0]
+    result.compute(scheduler='synchronous')
+    tracemalloc.start()
+    result.compute(scheduler='synchronous')
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    # the fields of the chunk, written in place, and the one returned; not
+    # another copy of the fields (the inputs are broadcast scalars)
+    assert peak < (len(fields) + 1) * 8 * s.size * 1.1
+
+
+@pytest.mark.parametrize('fields', [['rho', 'drhodt'], ['drhods', 'rho'],
+                                    ['drhodt', 'drhods']])
+def test_eos_fields_pairs(fields, s_t_p):
+    # the fused kernels of two fields agree with that of all three
+    expected = dict(zip(['rho', 'drhodt', 'drhods'], rho_and_derivatives(*s_t_p)))
+    for dtype in [None, 'f4']:
+        for a, f in zip(eos_fields(*s_t_p, fields=fields, dtype=dtype), fields):
+            np.testing.assert_array_equal(a, expected[f].astype(dtype or 'f8'))
+    # written into out, without a temporary for the third field
+    import tracemalloc
+    s, t, p = [np.full(10 ** 5, v) for v in (35.5, 3., 3000.)]
+    out = (np.empty_like(s), np.empty_like(s))
+    eos_fields(s, t, p, fields=fields, out=out)
+    tracemalloc.start()
+    eos_fields(s, t, p, fields=fields, out=out)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert peak < 8 * s.size / 2
+
+
+def test_eos_fields_out(s_t_p):
+    s, t, p = s_t_p
+    fields = ['rho', 'sigma0', 'alpha', 'beta']
+    expected = eos_fields(s, t, p, fields=fields)
+    out = tuple(np.empty_like(s) for _ in fields)
+    actual = eos_fields(s, t, p, fields=fields, out=out)
+    for a, o, e in zip(actual, out, expected):
+        assert a is o
+        np.testing.assert_array_equal(a, e)
+    out = np.empty_like(s)
+    assert eos_fields(s, t, p, fields=['rho'], out=out)[0] is out
+    with pytest.raises(ValueError):
+        eos_fields(s, t, p, fields=fields, out=out[:2])
+
+
+def test_eos_fields_invalid():
+    with pytest.raises(ValueError):
+        eos_fields(35.5, 3., 3000., fields=['rho', 'density'])
+    with pytest.raises(ValueError):
+        eos_fields(35.5, 3., 3000., fields=[])
+
+
+@pytest.mark.parametrize('array_type', ['numpy'] + all_arrays + ['xarrays_dask'])
+def test_instrument(threaded_client, array_type, s_t_p):
+    from fastjmd95.instrument import Recorder
+    s, t, p = s_t_p
+    if array_type == 'dask_arrays':
+        s, t, p = _chunk(s, t, p)
+    elif array_type == 'xarrays':
+        s, t, p = _make_xarray(s, t, p)
+    elif array_type == 'xarrays_dask':
+        s, t, p = _make_xarray(s, t, p, withdask=True)
+    path = {'numpy': 'numpy', 'dask_arrays': 'dask'}.get(array_type, 'xarray')
+    recorder = Recorder()
+    calls = []
+    with set_options(instrument=recorder):
+        np.asarray(rho(s, t, p))
+        np.asarray(eos_fields(s, t, p, fields=['rho', 'alpha'])[0])
+        with set_options(instrument=calls.append):
+            np.asarray(drhodt(s, t, p, dtype='f4'))
+    np.asarray(rho(s, t, p))
+    size = s_t_p[0].size
+    assert set(recorder.totals) == {('rho', path, np.dtype('f8')),
+                                    ('eos_fields', path, np.dtype('f8'))}
+    for totals in recorder.totals.values():
+        assert totals.elements == size
+        assert totals.calls == (1 if array_type in ('numpy', 'xarrays') else 6)
+        assert totals.seconds > 0
+    assert sum(c.elements for c in calls) == size
+    assert all(c[:3] == ('drhodt', path, np.dtype('f4')) for c in calls)
+    with pytest.raises(ValueError):
+        set_options(instrument='rho')
+
+
+def test_options_of_dask_blocks(monkeypatch, s_t_p):
+    # the options at graph construction apply when the blocks are computed
+    from fastjmd95 import jmd95wrapper
+    threads = []
+    monkeypatch.setattr(jmd95wrapper, '_with_num_threads',
+                        lambda kernel, num_threads: threads.append(num_threads) or kernel)
+    s, t, p = _chunk(*s_t_p)
+    with set_options(engine='parallel', parallel_threshold=0, num_threads=1):
+        result = rho(s, t, p)
+    del threads[:]  # dask's probes for the type of the result
+    np.testing.assert_array_equal(result.compute(scheduler='synchronous'), rho(*s_t_p))
+    assert threads == [1] * s.numblocks[0]
+
+
+def test_instrument_processes(s_t_p):
+    import pickle
+    from fastjmd95.instrument import Recorder
+    recorder = Recorder()
+    with set_options(instrument=recorder):
+        rho(*s_t_p)
+    copy = pickle.loads(pickle.dumps(recorder))
+    assert copy.totals == recorder.totals
+    with set_options(instrument=copy):
+        rho(*s_t_p)
+    assert copy.totals[('rho', 'numpy', np.dtype('f8'))].calls == 2
+    # the blocks are recorded by the copies in the worker processes
+    recorder.reset()
+    s, t, p = _chunk(*s_t_p)
+    with set_options(instrument=recorder):
+        actual = rho(s, t, p).compute(scheduler='processes')
+    np.testing.assert_array_equal(actual, rho(*s_t_p))
+    assert recorder.totals == {}
+
+
+def _make_dataset(s, t, p, chunks=None):
+    shape = (5, 19, 6)
+    coords = {'Z': -np.arange(5) * 1000., 'j': np.arange(19), 'i': np.arange(6)}
+    dims = ['Z', 'j', 'i']
+    ds = xr.Dataset({'SALT': (dims, s.reshape(shape), {'units': 'psu'}),
+                     'THETA': (dims, t.reshape(shape)),
+                     'PRESS': (dims, p.reshape(shape))},
+                    coords=coords, attrs={'title': 'test'})
+    if chunks:
+        ds = ds.chunk(chunks)
+    return ds
+
+
+@pytest.mark.parametrize('chunks', [None, {'Z': 1, 'j': 10}])
+def test_dataset_accessor(s_t_p, chunks):
+    s, t, p = s_t_p
+    ds = _make_dataset(s, t, p, chunks=chunks)
+    fields = ['rho', 'sigma0', 'alpha', 'beta']
+    out = ds.jmd95.compute(fields=fields, salt='SALT', theta='THETA',
+                           pressure='PRESS')
+    assert isinstance(out, xr.Dataset)
+    assert list(out.data_vars) == fields
+    assert out.attrs == ds.attrs
+    assert out.rho.attrs['units'] == 'kg m-3'
+    for name in fields:
+        assert out[name].dims == ds.SALT.dims
+        assert out[name].chunks == ds.SALT.chunks
+        xr.testing.assert_equal(out[name].Z, ds.Z)
+    shape = ds.SALT.shape
+    np.testing.assert_allclose(out.rho, rho_expected.reshape(shape), rtol=1e-2)
+    np.testing.assert_allclose(out.alpha, alpha_expected.reshape(shape), rtol=1e-2)
+    np.testing.assert_allclose(out.beta, beta_expected.reshape(shape), rtol=1e-2)
+    surface = rho_expected.reshape(shape)[0] - 1000
+    np.testing.assert_allclose(out.sigma0.isel(Z=0), surface, rtol=1e-2)
+    np.testing.assert_allclose(out.sigma0,
+                               np.broadcast_to(surface, shape), rtol=1e-2)
+
+
+def test_dataset_accessor_scalar_pressure(s_t_p):
+    s, t, p = s_t_p
+    ds = _make_dataset(s, t, p)
+    out = ds.jmd95.compute(fields=['rho'], pressure=0.)
+    np.testing.assert_allclose(out.rho.isel(Z=0),
+                               rho_expected.reshape(ds.SALT.shape)[0], rtol=1e-2)
+    with pytest.raises(ValueError):
+        ds.jmd95.compute(fields=['rho'])
+
+
+@pytest.mark.parametrize('chunks', [None, {'Z': 1, 'j': 10}])
+def test_dataset_accessor_depth(s_t_p, chunks):
+    s, t, p = s_t_p
+    ds = _make_dataset(s, t, p, chunks=chunks)
+    fields = ['rho', 'alpha', 'beta', 'sigma1']
+    out = ds.jmd95.compute(fields=fields, depth='Z')
+    assert list(out.data_vars) == fields
+    expected = rho_z(ds.SALT, ds.THETA, ds.Z)
+    xr.testing.assert_allclose(out.rho, expected)
+    xr.testing.assert_allclose(out.alpha, -drhodt_z(ds.SALT, ds.THETA, ds.Z) / expected)
+    xr.testing.assert_allclose(out.beta, drhods_z(ds.SALT, ds.THETA, ds.Z) / expected)
+    xr.testing.assert_allclose(out.sigma1, sigma1(ds.SALT, ds.THETA))
+    # Z is a height: the densities are those at positive pressure
+    np.testing.assert_allclose(out.rho, rho_expected.reshape(ds.SALT.shape), rtol=1e-2)
+    with pytest.raises(ValueError):
+        ds.jmd95.compute(fields=['rho'], pressure='PRESS', depth='Z')
+    with pytest.raises(ValueError):
+        ds.jmd95.compute(fields=['density'], depth='Z')
+    if chunks is None:
+        # heights are not pressures
+        with pytest.raises(ValueError):
+            ds.jmd95.compute(fields=['rho'], pressure='Z')
+
+
+@pytest.mark.parametrize('fields', [['rho', 'alpha', 'beta', 'sigma1'],
+                                    ['drhods', 'rho', 'drhodt'], ['drhodt', 'rho'],
+                                    ['alpha'], ['beta', 'drhods']])
+def test_eos_fields_z(fields, s_t_p):
+    from fastjmd95 import eos_fields_z
+    s, t, p = s_t_p
+    z, lat = -p, np.linspace(-60., 60., p.size)
+    expected = {'rho': rho_z(s, t, z, lat), 'drhodt': drhodt_z(s, t, z, lat),
+                'drhods': drhods_z(s, t, z, lat), 'sigma1': sigma1(s, t)}
+    expected['alpha'] = -expected['drhodt'] / expected['rho']
+    expected['beta'] = expected['drhods'] / expected['rho']
+    actual = eos_fields_z(s, t, z, lat, fields=fields)
+    assert len(actual) == len(fields)
+    for a, f in zip(actual, fields):
+        np.testing.assert_allclose(a, expected[f], rtol=1e-13)
+    # one task per chunk for dask arrays
+    sd, td, zd = _chunk(s, t, z)
+    actual = eos_fields_z(sd, td, zd, fields=fields)
+    layers = set.intersection(*[set(a.dask.layers) for a in actual])
+    assert len([name for name in layers if name.startswith(('stacked', '_fields'))]) == 1
+    for a, e in zip(actual, eos_fields_z(s, t, z, fields=fields)):
+        np.testing.assert_array_equal(a.compute(), e)
+
+
+@pytest.fixture
+def s_t_levels(s_t_p):
+    # (level, j, i) fields, with one pressure per level
+    s, t, p = s_t_p
+    shape = (5, 19, 6)
+    return s.reshape(shape), t.reshape(shape), p.reshape(shape)[:, 0, 0]
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_rho_levels(s_t_levels, dtype):
+    s, t, p = [a.astype(dtype) for a in s_t_levels]
+    expected = rho(s, t, p[:, None, None])
+    actual = rho_levels(s, t, p, axis=0)
+    assert actual.dtype == dtype
+    np.testing.assert_allclose(actual, expected, rtol=1e-6 if dtype == np.float32 else 1e-13)
+    np.testing.assert_allclose(actual, rho_expected.reshape(s.shape), rtol=1e-2)
+    # vertical axis last
+    actual_last = rho_levels(np.moveaxis(s, 0, -1), np.moveaxis(t, 0, -1), p, axis=-1)
+    np.testing.assert_array_equal(np.moveaxis(actual_last, -1, 0), actual)
+    # evaluated in float64, with float64 coefficients, for float32 fields too
+    s8, t8, p8 = [a.astype('f8') for a in (s, t, p)]
+    expected = rho(s8, t8, p8[:, None, None])
+    np.testing.assert_allclose(actual, expected, rtol=1e-7)
+    actual = rho_levels(s, t, p, axis=0, dtype='f8')
+    assert actual.dtype == np.float64
+    np.testing.assert_allclose(actual, expected, rtol=1e-13)
+
+
+def test_rho_levels_dask(s_t_levels):
+    s, t, p = s_t_levels
+    expected = rho_levels(s, t, p, axis=0)
+    sd, td = [dask.array.from_array(a, chunks=(2, 10, 6)) for a in (s, t)]
+    actual = rho_levels(sd, td, p, axis=0)
+    assert actual.chunks == sd.chunks
+    np.testing.assert_array_equal(actual.compute(), expected)
+
+
+@pytest.mark.parametrize('withdask', [False, True])
+def test_rho_levels_xarray(s_t_levels, withdask):
+    s, t, p = s_t_levels
+    expected = rho_levels(s, t, p, axis=0)
+    dims = ['Z', 'j', 'i']
+    sx, tx = [xr.DataArray(a, dims=dims) for a in (s, t)]
+    if withdask:
+        sx, tx = sx.chunk({'Z': 2}), tx.chunk({'Z': 2})
+    actual = rho_levels(sx, tx, xr.DataArray(p, dims=['Z']))
+    assert actual.dims == tuple(dims)
+    np.testing.assert_array_equal(actual.values, expected)
+    actual = rho_levels(sx, tx, p, axis='Z')
+    np.testing.assert_array_equal(actual.values, expected)
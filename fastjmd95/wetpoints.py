@@ -0,0 +1,145 @@
+import numpy as np
+
+try:
+    import dask.array as dsa
+except ImportError:
+    dsa = None
+
+try:
+    import xarray as xr
+except ImportError:
+    xr = None
+
+
+class WetPoints:
+    """
+    The wet points of a grid, for storing fields as contiguous 1-D arrays of
+    their ocean values only.
+
+    Fields are packed once; every fastjmd95 function works on the packed
+    arrays directly, and results are scattered back onto the grid only when
+    needed, eagerly or lazily with dask. Fields may have leading dimensions
+    that the mask does not have, such as time: they are packed to arrays of
+    shape ``(..., size)``.
+
+    Parameters
+    ----------
+    mask : array_like of bool or DataArray
+        True at wet points, e.g. ``hFacC > 0``. If it is a DataArray, fields
+        are unpacked as DataArrays with its dimensions and coordinates.
+
+    Examples
+    --------
+    >>> wet = WetPoints(ds.hFacC > 0)
+    >>> s, t, p = wet.pack(ds.SALT), wet.pack(ds.THETA), wet.pack(-ds.Z)
+    >>> rho = fastjmd95.rho(s, t, p)
+    >>> alpha, beta = fastjmd95.alpha_beta(s, t, p)
+    >>> wet.unpack(rho)
+    >>> wet.unpack((alpha, beta), lazy=True)
+    """
+
+    def __init__(self, mask):
+        self._template = mask if xr is not None and isinstance(mask, xr.DataArray) else None
+        self.mask = np.asarray(mask, dtype=bool)
+        self.shape = self.mask.shape
+        # the index map: flat (C order) grid index of each packed point
+        self.index = np.flatnonzero(self.mask)
+
+    @property
+    def size(self):
+        """ Number of wet points """
+        return self.index.size
+
+    def pack(self, field):
+        """
+        Wet points of `field` along its last axis, after any leading
+        dimensions that the grid does not have. DataArrays are lined up with
+        a DataArray mask by dimension name, their other dimensions first;
+        other fields are broadcast against the grid like numpy arrays.
+        """
+        if self._template is not None and isinstance(field, xr.DataArray):
+            field = field.broadcast_like(self._template)
+            field = field.transpose(..., *self._template.dims)
+        field = np.asarray(field)
+        lead = field.shape[:max(field.ndim - len(self.shape), 0)]
+        return np.broadcast_to(field, lead + self.shape)[..., self.mask]
+
+    def apply(self, func, *fields, **kwargs):
+        """
+        `func` (e.g. `fastjmd95.rho`) on the packed `fields`; fields that
+        are already packed, or scalars, are used as they are.
+        """
+        packed = [f if np.ndim(f) == 0 or self._is_packed(f) else self.pack(f)
+                  for f in fields]
+        return func(*packed, **kwargs)
+
+    def _is_packed(self, field):
+        shape = np.shape(field)
+        return shape[-1:] == (self.size,) and (
+            len(shape) == 1 or shape[-len(self.shape):] != self.shape)
+
+    def unpack(self, packed, fill_value=np.nan, lazy=False, dims=None):
+        """
+        Scatter `packed` values back onto the grid, with `fill_value` at dry
+        points.
+
+        Parameters
+        ----------
+        packed : array or tuple of arrays
+            Packed values, e.g. the result of `apply`, with the wet points
+            along the last axis.
+        fill_value : scalar, optional
+            Value at dry points; default: NaN.
+        lazy : bool, optional
+            Return a dask array, chunked by the first dimension of the grid
+            and by single steps of any leading dimensions, that only
+            scatters a chunk when it is computed.
+        dims : sequence of str, optional
+            With a DataArray mask, names of the leading dimensions of
+            `packed`; default: ``dim_0``, ``dim_1``, ...
+        """
+        if isinstance(packed, tuple):
+            return tuple(self.unpack(p, fill_value, lazy, dims) for p in packed)
+        packed = np.asarray(packed)
+        if packed.shape[-1:] != (self.size,):
+            raise ValueError("expected %d packed values along the last axis, got an "
+                             "array of shape %s" % (self.size, packed.shape))
+        lead = packed.shape[:-1]
+        dtype = np.result_type(packed, fill_value)
+        if lazy:
+            if dsa is None:
+                raise ImportError("lazy unpacking requires dask")
+            field = self._unpack_lazy(packed, fill_value, dtype)
+        else:
+            field = np.full(lead + self.shape, fill_value, dtype=dtype)
+            field[..., self.mask] = packed
+        if self._template is not None:
+            dims = ['dim_%d' % n for n in range(len(lead))] if dims is None else list(dims)
+            field = xr.DataArray(field, dims=dims + list(self._template.dims),
+                                 coords=self._template.coords)
+            # not the name of the dask array
+            field.name = None
+        return field
+
+    def _unpack_lazy(self, packed, fill_value, dtype):
+        # the points of a slab of the first dimension are contiguous in the
+        # packed array, so each task gets those points and the mask of its
+        # slab only, as blocks of dask arrays chunked alike
+        rows = self.mask.reshape(self.shape[0], -1)
+        lead = packed.shape[:-1]
+        packed = dsa.from_array(packed, chunks=tuple((1,) * n for n in lead)
+                                + (tuple(rows.sum(axis=1).tolist()),))
+        mask = dsa.from_array(self.mask, chunks=(1,) + self.shape[1:])
+
+        def scatter(mask, packed):
+            block = np.full(packed.shape[:-1] + mask.shape, fill_value, dtype=dtype)
+            block[..., mask] = packed
+            return block
+
+        lead_index = tuple(range(len(lead)))
+        index = tuple(range(len(lead), len(lead) + len(self.shape)))
+        return dsa.blockwise(scatter, lead_index + index, mask, index,
+                             packed, lead_index + index[:1], align_arrays=False,
+                             dtype=dtype,
+                             meta=np.empty((0,) * (len(lead) + len(self.shape)),
+                                           dtype=dtype))
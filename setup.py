@@ -38,6 +38,7 @@ setup(
     name=DISTNAME,
     version=versioneer.get_version(),
     cmdclass=versioneer.get_cmdclass(),
+    entry_points={"console_scripts": ["fastjmd95 = fastjmd95.cli:main"]},
     license=LICENSE,
     author=AUTHOR,
     author_email=AUTHOR_EMAIL,